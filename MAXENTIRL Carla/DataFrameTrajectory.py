@@ -1,12 +1,27 @@
 
+import os
 import numpy as np
 import pandas as pd
 import glob
+from trajectoryStore import readTrajectoryStore
 
 
 class DataFrameTrajectory(object):
 
-    def __init__(self, prefix="traj", path=None):
+    def __init__(self, prefix="traj", path=None, cache=True, store=None):
+        """
+        cache:  Store all trajectories in a single binary file (prefix + "Cache.npz") after the first load.
+                The cache is rebuilt when the set of csv files or their modification times change.
+        store:  Name of a trajectory store (store + ".steps" and store + ".offsets") recorded in CARLA,
+                which is read instead of the csv files.
+        """
+        self.columns_titles = ["lightIsRed", "distanceToGoal", "performedStop"]
+        if store is not None:
+            self.steps, self.offsets = self.readStore(store)
+            self.dfs = self.splitTrajectories()
+            self.stateTable = self.generateStateTable()
+            return
+
         files = self.findTrajectories(prefix, path)
 
         def retrieveCsvNumber(fileName):
@@ -19,13 +34,31 @@ class DataFrameTrajectory(object):
 
         files.sort(key=lambda x: retrieveCsvNumber(x))
 
+        # steps contains all steps of all trajectories concatenated, the steps of trajectory i
+        # are stored in the rows offsets[i] up to offsets[i+1]
+        self.steps, self.offsets = None, None
+        cacheFile = prefix + "Cache.npz"
+        if cache:
+            self.steps, self.offsets = self.loadCache(cacheFile, files)
+        if self.steps is None:
+            self.steps, self.offsets = self.readCsvFiles(files)
+            if cache:
+                self.saveCache(cacheFile, files)
+
         # dfs contains all trajectories, stored as a list of dfs
-        self.dfs = []
-        for file in files:
-            self.dfs.append(self.csvToDf(file))
- 
+        self.dfs = self.splitTrajectories()
+
         self.stateTable = self.generateStateTable()
 
+    def splitTrajectories(self):
+        """
+        Splits the concatenated steps into a df per trajectory
+        """
+        dfs = []
+        for begin, end in zip(self.offsets[:-1], self.offsets[1:]):
+            dfs.append(pd.DataFrame(self.steps[begin:end], columns=self.columns_titles))
+        return dfs
+
 
     def generateStateTable(self):
         """
@@ -37,7 +70,7 @@ class DataFrameTrajectory(object):
 
     def findTrajectories(self, prefix="traj", path=None):
         """
-        Finds all csv files for a given prefix either in the current folder, or a provided path folder. 
+        Finds all csv files for a given prefix either in the current folder, or a provided path folder.
         """
         path = prefix + r'*.csv'
         files = glob.glob(path)
@@ -47,11 +80,58 @@ class DataFrameTrajectory(object):
     def csvToDf(self, file):
         df = pd.read_csv(file)
 
-        columns_titles = ["lightIsRed", "distanceToGoal", "performedStop"]
-        df = df.reindex(columns=columns_titles) # make the action (stop) the last action
+        df = df.reindex(columns=self.columns_titles) # make the action (stop) the last action
 
         return df
 
+    def readStore(self, store):
+        """
+        Reads the steps and offsets of the trajectory store
+        """
+        steps, offsets = readTrajectoryStore(store)
+        # The first trajectory is always inconsistent, and is thus removed
+        if len(offsets) > 1:
+            steps, offsets = steps[offsets[1]:], offsets[1:] - offsets[1]
+        return steps, offsets
+
+    def readCsvFiles(self, files):
+        """
+        Reads all trajectory csv files and concatenates their steps into a single array with an offsets index
+        """
+        arrays = [self.csvToDf(file).to_numpy(dtype=np.float64) for file in files]
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(array) for array in arrays])
+
+        if arrays:
+            steps = np.concatenate(arrays)
+        else:
+            steps = np.empty((0, len(self.columns_titles)))
+        return steps, offsets
+
+    def loadCache(self, cacheFile, files):
+        """
+        Loads the concatenated steps and offsets from the cache.
+        Returns (None, None) if there is no cache or if it does not match the current csv files.
+        """
+        if not os.path.exists(cacheFile):
+            return None, None
+
+        with np.load(cacheFile) as cache:
+            if cache["files"].tolist() != files \
+                    or not np.array_equal(cache["mtimes"], self.modificationTimes(files)):
+                return None, None
+            return cache["steps"], cache["offsets"]
+
+    def saveCache(self, cacheFile, files):
+        """
+        Saves the concatenated steps and offsets together with the csv files they were read from
+        """
+        np.savez(cacheFile, steps=self.steps, offsets=self.offsets,
+                 files=np.array(files, dtype=str), mtimes=self.modificationTimes(files))
+
+    def modificationTimes(self, files):
+        return np.array([os.path.getmtime(file) for file in files], dtype=np.float64)
+
 
 def main():
     traj = DataFrameTrajectory(prefix="traj")
@@ -1,102 +1,123 @@
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 from DataFrameTrajectory import DataFrameTrajectory
 from carlaTrajectory import Trajectory
+import maxentCarla as M
+from stateIndex import StateIndex
+from transitionModel import SparseTransitionModel
+from transitionTable import TransitionTable, readCounts, readOverrides
+
+
+def buildTrajectories(dfs, stateTable, stateIndex, stateNumbers=None):
+    """
+    Creates a Trajectory for every df. stateNumbers holds the state numbers of the steps of every df,
+    if not provided the states are looked up per trajectory.
+    """
+    if stateNumbers is None:
+        stateNumbers = [None] * len(dfs)
+    return [Trajectory(df, stateTable, stateIndex, states) for df, states in zip(dfs, stateNumbers)]
 
 
 class Demonstration:
-    def __init__(self):
-        dfTrajectories = DataFrameTrajectory()
-        self.trajectories = []
+    def __init__(self, sparse=False, workers=None, store=None):
+        """
+        sparse:     Store the transition probabilities as a SparseTransitionModel (one CSR matrix per action)
+                    instead of a dense (n_states, n_actions, n_states) array. Use this for large state spaces.
+        workers:    Number of processes used to create the trajectories. By default the states of all
+                    trajectories are looked up in one batch and the trajectories are created in this process.
+        store:      Name of the trajectory store recorded in CARLA to read the trajectories from,
+                    by default the trajectories are read from the traj*.csv files.
+        """
+        self.sparse = sparse
+
+        dfTrajectories = DataFrameTrajectory(store=store)
 
         # State table contains the state and its features as a dataframe.
         self.stateTable = dfTrajectories.stateTable
         # print(self.stateTable)
+        # Index used to find the state number for given state features
+        self.stateIndex = StateIndex(self.stateTable)
 
         # dfTrajectories.dfs is a list of trajectories that are stores as df
-        for df in dfTrajectories.dfs:
-            self.trajectories.append(Trajectory(df, self.stateTable))
+        if workers is not None and workers > 1:
+            self.trajectories = self.buildTrajectoriesParallel(dfTrajectories.dfs, workers)
+        else:
+            # Look up the states of the steps of all trajectories at once in the concatenated steps
+            stateNumbers = np.split(self.stateIndex.findStates(dfTrajectories.steps),
+                                    dfTrajectories.offsets[1:-1])
+            self.trajectories = buildTrajectories(dfTrajectories.dfs, self.stateTable,
+                                                  self.stateIndex, stateNumbers)
 
         # The terminal states observed during the demonstration
         self.terminalStates = self.terminalState(self.trajectories)
 
+        # The number of visits to each state over all trajectories
+        self.stateVisitationCount = self.visitationCount(self.trajectories)
+
         # The transition table for every state-action pair
         self.transitionTable = self.generateTransitionTable()
 
         # The probability of transitioning to state s for every state-action pair
         self.p_transition = self.generateProbTransition()
 
-    def generateProbTransition(self, debug=False):
+    def buildTrajectoriesParallel(self, dfs, workers):
+        """
+        Creates the trajectories in a pool of worker processes, every worker creates the trajectories
+        of a consecutive batch of dfs. The order of the trajectories is preserved.
+        """
+        batches = [batch for batch in np.array_split(np.arange(len(dfs)), workers) if len(batch)]
+
+        trajectories = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(buildTrajectories, [dfs[i] for i in batch], self.stateTable, self.stateIndex)
+                       for batch in batches]
+            for future in futures:
+                trajectories.extend(future.result())
+        return trajectories
+
+    def generateProbTransition(self, debug=False, overrideFile="transitionOverrides.csv",
+                               countFile="stateTransitionCounts.csv", smoothing=0.0, overrideObserved=False):
         """
         Function used to create the transition probabilities for every (s,a,s')
+
+        overrideFile:   csv file with the custom probabilities [s,a,s',p] of the non deterministic states.
+        countFile:      csv file with the number of times every (s,a,s') has been observed. If it exists the
+                        probabilities are estimated from these counts, otherwise all other possible
+                        next-states of a state-action pair are equally likely.
+        smoothing:      Dirichlet smoothing added to every count of a possible transition.
+        overrideObserved: If True the custom probabilities also replace the estimates of state-action pairs
+                        with observed counts, otherwise only the unobserved pairs are overridden.
         """
         n_states = self.stateTable.shape[0]
 
-        stateActions = list(self.transitionTable.keys())
-        possibleActions = set()
-        for stateAction in stateActions:
-            possibleActions.add(int(stateAction.split("-")[1]))
+        n_actions = self.transitionTable.n_actions
 
-        n_actions = len(possibleActions)
-        pTable = np.zeros(shape=(n_states, n_actions, n_states))
-
-        # Set the transition probability for each state-action pair to equally likely for all the possible next-states
-        for stateAction, outcomeStates in self.transitionTable.items():
-            pair = stateAction.split("-")
-            outcomes = set(outcomeStates)
-            n_outcomes = len(outcomes)
-            while outcomes:
-                state = outcomes.pop()
-                pTable[int(pair[0]), int(pair[1]), state] = 1/n_outcomes
-
-        # list of custom probabilities holding [s,a,s',p]
-        customProbabilities = [[24, 1, 24, 0.99], [24, 1, 25, 0.01],
-                               [24, 0, 26, 0.99], [24, 0, 27, 0.01],
-
-                               [26, 1, 26, 0.99], [26, 1, 27, 0.01],
-                               [26, 0, 28, 0.99], [26, 0, 29, 0.01],
-
-                               [28, 1, 28, 0.99], [28, 1, 29, 0.01],
-                            #    [28, 0, 28, 0.99], [28, 1, 29, 0.01],
-                               
-                               [25, 1, 25, 0.99], [25, 1, 24, 0.01],
-                               [25, 0, 27, 0.99], [25, 0, 26, 0.01],
-
-                               [27, 1, 27, 0.99], [27, 1, 26, 0.01],
-                               [27, 0, 29, 0.99], [27, 0, 28, 0.01],
-
-                               [29, 1, 29, 0.99], [29, 1, 28, 0.01],
-                               ]
-        
-        for probabilty in customProbabilities:
-            pTable[probabilty[0], probabilty[1], probabilty[2]] = probabilty[3]
+        # Entries holding [s,a,s',p] for every possible transition
+        states, actions, nextStates, values = self.transitionTable.probabilities(
+            readOverrides(overrideFile), readCounts(countFile), smoothing, overrideObserved)
 
         if debug:
-            for s in range(pTable.shape[0]):
-                for a in range(pTable.shape[1]):
-                    for s_prime in range(pTable.shape[2]):
-                        if pTable[s][a][s_prime]>0:
-                            print("(", s,a, s_prime,") Has probability", pTable[s][a][s_prime])
+            for i in np.lexsort((nextStates, actions, states)):
+                if values[i] > 0:
+                    print("(", states[i], actions[i], nextStates[i], ") Has probability", values[i])
  
         if debug:
-            countPossibleTransitions = 0
-            for transitions in pTable:
-                countPossibleTransitions += np.count_nonzero(transitions)
+            countPossibleTransitions = np.count_nonzero(values)
             print("Number of possible transitions", countPossibleTransitions)
 
+        if self.sparse:
+            return SparseTransitionModel.from_entries(n_states, n_actions, states, actions, nextStates, values)
+
+        pTable = np.zeros(shape=(n_states, n_actions, n_states))
+        pTable[states, actions, nextStates] = values
         return pTable
 
     def generateTransitionTable(self):
         """"
-        Function which generates a dictonary with the transitions for each state-action pair
+        Function which loads the possible transitions for each state-action pair
         """
-        transitionDf = pd.read_csv("stateTransitions.csv")
-
-        stateActionTransitions = dict()
-        for _, row in transitionDf.iterrows():
-            stateActionTransitions[row['state-action']
-                                   ] = set(eval(row['transitions']))
-        return stateActionTransitions
+        return TransitionTable.load("stateTransitions.csv")
 
     def terminalState(self, trajectories):
         """
@@ -107,6 +128,12 @@ class Demonstration:
             terminals.add(traj.terminalState)
         return terminals
 
+    def visitationCount(self, trajectories):
+        """
+        Function to obtain the number of visits to every state, summed over all trajectories
+        """
+        return M.state_visitation_count(self.stateTable.shape[0], trajectories)
+
 
 def main():
     demo = Demonstration()
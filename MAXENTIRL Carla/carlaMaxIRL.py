@@ -1,8 +1,20 @@
+import argparse
+import itertools
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
 import optimizer as O
 import maxentCarla as M
 from carlaDemonstration import Demonstration
+from rewardModel import writeRewardModel
 import matplotlib.pyplot as plt
 
+# The demonstration used by the sweep workers, set once per worker process.
+workerDemonstration = None
+
 
 def maxent(demonstration):
     """
@@ -26,7 +38,8 @@ def maxent(demonstration):
 
     # actually do some inverse reinforcement learning
     reward, delta_list, theta_list = M.irl(p_transition,stateToFeatures,
-                   terminalStates, trajectories, optim, init)
+                   terminalStates, trajectories, optim, init,
+                   visitation_count=demonstration.stateVisitationCount)
 
     # Print the reward obtain for reaching any of the states
     for index, i in enumerate(reward):
@@ -34,18 +47,214 @@ def maxent(demonstration):
     return reward, delta_list, theta_list
 
 
+def compilePolicy(demonstration, featureweights):
+    """
+    Compiles the policy of the reward function with the given feature weights for the CARLA agent.
+
+    The action probabilities of every state are computed offline by soft value iteration (the backward pass of
+    MAXENTIRL) on the transition model of the demonstration, so that they account for all following steps.
+    """
+    reward = demonstration.stateTable.to_numpy(dtype=np.float64).dot(np.asarray(featureweights, dtype=np.float64))
+    return M.local_action_probabilities(demonstration.p_transition, demonstration.terminalStates, reward)
+
+
+def mostLikelyActions(p_action):
+    """
+    Returns the most likely action of every state, -1 for states without possible actions
+    """
+    return np.where(p_action.sum(axis=1) > 0, np.argmax(p_action, axis=1), -1).astype(np.int8)
+
+
+def exportRewardModel(demonstration, featureweights, output="rewardModel.irl"):
+    """
+    Writes the reward model of the given feature weights for the CARLA agent, see rewardModel.py.
+    It holds the feature weights, the state table and index, the entries of the transition model, the expected
+    reward of every state-action pair with the best action per state, and the compiled policy (see compilePolicy)
+    with its most likely action per state (-1 for states without possible actions).
+    """
+    featureweights = np.asarray(featureweights, dtype=np.float64)
+    stateFeatures = demonstration.stateTable.to_numpy(dtype=np.float64)
+    reward = stateFeatures.dot(featureweights)
+    p_action = compilePolicy(demonstration, featureweights)
+
+    # The entries (s,a,s',p) of the transition model
+    matrices = M.transition_matrices(demonstration.p_transition)
+    entries = [sp.coo_matrix(p) for p in matrices]
+    states = np.concatenate([p.row for p in entries]).astype(np.int64)
+    actions = np.concatenate([np.full(p.nnz, a) for a, p in enumerate(entries)]).astype(np.int64)
+    nextStates = np.concatenate([p.col for p in entries]).astype(np.int64)
+    probabilities = np.concatenate([p.data for p in entries]).astype(np.float64)
+
+    # The expected reward of every state-action pair, -inf for pairs without possible transitions
+    qTable = np.column_stack([p.dot(reward) for p in matrices])
+    qTable[np.column_stack([np.asarray(p.sum(axis=1)).reshape(-1) for p in matrices]) == 0] = -np.inf
+    bestActions = np.argmax(qTable, axis=1)
+
+    index = demonstration.stateIndex
+    metadata = {"featureNames": [str(c) for c in demonstration.stateTable.columns],
+                "decimals": int(round(np.log10(index.scale))),
+                "nStates": int(stateFeatures.shape[0]), "nActions": len(matrices),
+                "terminalStates": sorted(int(s) for s in demonstration.terminalStates)}
+    arrays = {"featureweights": featureweights, "stateFeatures": stateFeatures,
+              "stateKeys": index.keys, "stateNumbers": index.states,
+              "transitionStates": states, "transitionActions": actions,
+              "transitionNextStates": nextStates, "transitionProbabilities": probabilities,
+              "qTable": qTable, "bestActions": bestActions,
+              "actionProbabilities": np.asarray(p_action, dtype=np.float32),
+              "policyActions": mostLikelyActions(p_action)}
+    return writeRewardModel(output, arrays, metadata)
+
+
+def initWorker(demonstration):
+    """
+    Stores the demonstration in the worker process, so it is only transferred once per worker instead of per run
+    """
+    global workerDemonstration
+    workerDemonstration = demonstration
+
+
+def buildOptimizer(optimizer, schedule):
+    """
+    Creates the optimizer for a sweep configuration.
+
+    optimizer:  One of "Sga", "ExpSga" or "NormalizeGrad" (Sga with normalized gradient).
+    schedule:   Tuple (name, kwargs) of a learning-rate decay function in optimizer.py, e.g. ("exponential_decay", {"lr0": 0.2}).
+    """
+    name, kwargs = schedule
+    lr = getattr(O, name)(**kwargs)
+
+    if optimizer == "Sga":
+        return O.Sga(lr=lr)
+    elif optimizer == "ExpSga":
+        return O.ExpSga(lr=lr)
+    elif optimizer == "NormalizeGrad":
+        return O.Sga(lr=lr).normalize_grad()
+    raise ValueError("Unknown optimizer " + str(optimizer))
+
+
+def runConfiguration(configuration):
+    """
+    Runs the MAXENTIRL algorithm for a single sweep configuration on the demonstration of the worker.
+
+    A run converged if it stopped before maxSteps with finite feature weights and the gradient, the difference
+    between the feature expectation of the demonstration and the expected features of the learned reward, is at
+    most gradientTolerance relative to the feature expectation of the demonstration. The random initializers
+    draw from a generator seeded with the seed of the configuration, so every run can be repeated.
+    """
+    (initName, initKwargs), optimizer, schedule, maxSteps, gradientTolerance, seed = configuration
+    demonstration = workerDemonstration
+    stateFeatures = demonstration.stateTable.to_numpy()
+    n_states, n_features = stateFeatures.shape
+
+    kwargs = dict(initKwargs)
+    if initName == "Uniform":
+        kwargs["rng"] = np.random.default_rng(seed)
+    initialTheta = getattr(O, initName)(**kwargs)(n_features)
+    init = O.Constant(lambda shape: initialTheta)
+    optim = buildOptimizer(optimizer, schedule)
+
+    start = time.perf_counter()
+    try:
+        reward, delta_list, _ = M.irl(demonstration.p_transition, demonstration.stateTable,
+                                      demonstration.terminalStates, demonstration.trajectories, optim, init,
+                                      direct_svf=True, visitation_count=demonstration.stateVisitationCount,
+                                      max_steps=maxSteps)
+        diverged = False
+    except M.DivergenceError as e:
+        delta_list = e.delta_list
+        diverged = True
+    wallTime = time.perf_counter() - start
+
+    theta = np.array(optim.parameters, dtype=np.float64)
+    diverged = diverged or not np.all(np.isfinite(theta))
+    gradient = np.inf
+    if not diverged:
+        # The gradient of the log-likelihood at the learned feature weights
+        e_features = M.feature_expectation_from_trajectories(stateFeatures, demonstration.trajectories,
+                                                             demonstration.stateVisitationCount)
+        p_initial = M.initial_probabilities_from_trajectories(n_states, demonstration.trajectories)
+        e_svf = M.compute_expected_svf(demonstration.p_transition, p_initial, demonstration.terminalStates,
+                                       stateFeatures.dot(theta), 1e-10, 1e-10, direct=True)
+        if np.all(np.isfinite(e_svf)):
+            gradient = np.max(np.abs(e_features - stateFeatures.T.dot(e_svf))) / np.max(np.abs(e_features))
+
+    result = {"initializer": initName + str(initKwargs),
+              "optimizer": optimizer,
+              "schedule": schedule[0] + str(schedule[1]),
+              "seed": seed,
+              "steps": len(delta_list),
+              "gradient": gradient,
+              "converged": not diverged and len(delta_list) < maxSteps and gradient <= gradientTolerance,
+              "diverged": diverged,
+              "wallTime": wallTime}
+    for feature, weight in zip(demonstration.stateTable.columns, initialTheta):
+        result["initial " + str(feature)] = weight
+    for feature, weight in zip(demonstration.stateTable.columns, theta):
+        result[feature] = weight
+    return result
+
+
+def sweep(demonstration, initializers, optimizers, schedules, maxSteps=500, maxWorkers=None, output="sweep.csv",
+          gradientTolerance=1e-3, seed=0):
+    """
+    Runs the MAXENTIRL algorithm for every combination of the given initializers, optimizers and learning-rate
+    schedules in a process pool and writes the results table to a csv file.
+
+    initializers:       List of (name, kwargs) of an Initializer in optimizer.py, e.g. ("Constant", {"value": 0.2}).
+    optimizers:         List of optimizer names, see buildOptimizer.
+    schedules:          List of (name, kwargs) of a learning-rate decay function in optimizer.py.
+    maxSteps:           The maximum number of optimization steps per run, runs that did not converge are marked.
+                        Runs whose state visitation frequency or feature weights diverge are stopped and marked as
+                        diverged, with the feature weights of their last step.
+    gradientTolerance:  The largest relative gradient of a converged run, see runConfiguration.
+    seed:               The seed of the first configuration, configuration i is seeded with seed + i. The seed and
+                        the initial feature weights of every run are written to the results table.
+    """
+    configurations = [(init, optimizer, schedule, maxSteps, gradientTolerance, seed + i)
+                      for i, (init, optimizer, schedule)
+                      in enumerate(itertools.product(initializers, optimizers, schedules))]
+
+    with ProcessPoolExecutor(max_workers=maxWorkers, initializer=initWorker,
+                             initargs=(demonstration,)) as executor:
+        results = list(executor.map(runConfiguration, configurations))
+
+    df = pd.DataFrame(results)
+    df.to_csv(output, index=False)
+    return df
+
+
+def mainSweep(maxWorkers=None, seed=0):
+    demonstration = Demonstration()
+
+    initializers = [("Constant", {"value": 0.2}), ("Constant", {"value": 0.1}), ("Uniform", {"low": 0.0, "high": 1.0})]
+    optimizers = ["Sga", "ExpSga", "NormalizeGrad"]
+    schedules = [("linear_decay", {"lr0": 0.2}), ("power_decay", {"lr0": 0.2}), ("exponential_decay", {"lr0": 0.2})]
+
+    results = sweep(demonstration, initializers, optimizers, schedules, maxWorkers=maxWorkers, seed=seed)
+    print(results)
+
+
+def mainPolicy(featureweights, output="rewardModel.irl"):
+    demonstration = Demonstration()
+    metadata = exportRewardModel(demonstration, featureweights, output)
+    print("Policy of feature weights", featureweights, "written to", output,
+          "(version " + str(metadata["modelVersion"]) + ")")
+
+
 def main():
     demonstration = Demonstration()
     rewardFunction, deltas, thetas = maxent(demonstration)
 
+    # Compile the policy and reward model of the learned feature weights for the CARLA agent
+    featureweights = [theta[-1] for theta in thetas]
+    exportRewardModel(demonstration, featureweights)
+
     # Calculate the state-action values
-    for key, value in demonstration.transitionTable.items():
+    for (beginState, action), resultingStates in demonstration.transitionTable.items():
         reward = 0.0
-        beginState, action = key.split("-")
-        while value:
-            resultingState = value.pop()
-            reward += (rewardFunction[resultingState] * demonstration.p_transition[int(beginState),int(action),int(resultingState)])
-        print(key, reward)
+        for resultingState in resultingStates:
+            reward += (rewardFunction[resultingState] * demonstration.p_transition[beginState, action, resultingState])
+        print(str(beginState) + "-" + str(action), reward)
 
     plt.plot(deltas, 'ro',markersize=3)
     plt.title("Difference in the feature weight vector after each optimization step")
@@ -73,4 +282,33 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    argparser = argparse.ArgumentParser(description='Maximum Entropy Inverse Reinforcement Learning')
+    argparser.add_argument(
+        '--sweep',
+        action='store_true',
+        help='Run a hyperparameter sweep and write the results to sweep.csv')
+    argparser.add_argument(
+        '-w', '--workers',
+        default=None,
+        type=int,
+        help='Number of worker processes used by the sweep (default: number of cores)')
+    argparser.add_argument(
+        '--seed',
+        default=0,
+        type=int,
+        help='Seed of the first sweep configuration, configuration i is seeded with seed + i (default: 0)')
+    argparser.add_argument(
+        '--policy',
+        nargs='+',
+        default=None,
+        type=float,
+        metavar='WEIGHT',
+        help='Only compile the policy of the given feature weights and write it to rewardModel.irl')
+    args = argparser.parse_args()
+
+    if args.sweep:
+        mainSweep(args.workers, args.seed)
+    elif args.policy:
+        mainPolicy(args.policy)
+    else:
+        main()
@@ -0,0 +1,223 @@
+"""
+Headless tabular simulator of the CARLA scenario.
+
+The simulator samples episodes from the transition model learned from the
+demonstration (`Demonstration.p_transition`), starting in the start states of
+the demonstrated trajectories, under the MaxEnt policy of any feature weight
+vector. All episodes are simulated at once with NumPy, so candidate feature
+weights can be screened in seconds before running the IRL agent in CARLA.
+
+Per episode the return (the sum of the rewards of all visited states), the
+number of steps until a terminal state is reached and the actions taken while
+the traffic light is red are recorded. The action 1 is the stop action, as in
+the `performedStop` column of the trajectories.
+"""
+
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import maxentCarla as M
+from carlaDemonstration import Demonstration
+
+
+class TabularSimulator:
+    """
+    Simulates episodes of the MDP given by the transition model.
+
+    Args:
+        p_transition: The transition probabilities as dense `(n_states, n_actions, n_states)` table or
+            `SparseTransitionModel`.
+        stateTable: The state table as dataframe with the state features as columns.
+        terminalStates: The states in which an episode ends.
+        p_initial: The probability of every state to be the start state.
+    """
+    def __init__(self, p_transition, stateTable, terminalStates, p_initial):
+        self.p_transition = p_transition
+        self.stateTable = stateTable
+        self.stateFeatures = stateTable.to_numpy(dtype=np.float64)
+        self.n_states, self.n_actions, _ = p_transition.shape
+
+        self.terminalStates = sorted(terminalStates)
+        self.terminal = np.zeros(self.n_states, dtype=bool)
+        self.terminal[self.terminalStates] = True
+        self.lightIsRed = stateTable['lightIsRed'].to_numpy() > 0.5
+
+        self.p_initial = np.asarray(p_initial, dtype=np.float64)
+        self.initialCdf = np.cumsum(self.p_initial)
+
+        # The transitions of all state-action pairs (row s * n_actions + a) in CSR format. The cumulative
+        # probabilities of row r are shifted by r, so the next-states of all rows are sampled with one searchsorted.
+        rows, nextStates, probabilities = [], [], []
+        for a, p in enumerate(M.transition_matrices(p_transition)):
+            s, s_prime = np.nonzero(p)
+            rows.append(s * self.n_actions + a)
+            nextStates.append(s_prime)
+            probabilities.append(np.asarray(p[s, s_prime], dtype=np.float64).reshape(-1))
+        rows, nextStates, probabilities = np.concatenate(rows), np.concatenate(nextStates), np.concatenate(probabilities)
+
+        order = np.argsort(rows, kind='stable')
+        rows, self.nextStates, probabilities = rows[order], nextStates[order], probabilities[order]
+        n_rows = self.n_states * self.n_actions
+        self.rowSums = np.bincount(rows, weights=probabilities, minlength=n_rows)
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=n_rows))))
+        withinRow = np.cumsum(probabilities) - np.repeat(np.concatenate(([0.0], np.cumsum(probabilities)))[indptr[:-1]],
+                                                         np.diff(indptr))
+        self.shiftedCdf = rows + withinRow / np.where(self.rowSums[rows] > 0, self.rowSums[rows], 1.0)
+        # Avoid rounding errors at the end of the rows, a sample r + u with u < 1 must stay in row r
+        rowEnds = indptr[1:][np.diff(indptr) > 0] - 1
+        self.shiftedCdf[rowEnds] = rows[rowEnds] + 1.0
+
+    @classmethod
+    def fromDemonstration(cls, demonstration):
+        """
+        Creates the simulator of the transition model, terminal states and start states of the demonstration
+        """
+        n_states = demonstration.stateTable.shape[0]
+        p_initial = M.initial_probabilities_from_trajectories(n_states, demonstration.trajectories)
+        return cls(demonstration.p_transition, demonstration.stateTable, demonstration.terminalStates, p_initial)
+
+    def rewards(self, featureweights):
+        """
+        Returns the reward of every state for the given feature weights
+        """
+        return self.stateFeatures.dot(np.asarray(featureweights, dtype=np.float64))
+
+    def policy(self, featureweights):
+        """
+        Returns the MaxEnt policy (action probabilities per state) of the reward with the given feature weights
+        """
+        return M.local_action_probabilities(self.p_transition, self.terminalStates, self.rewards(featureweights))
+
+    def rollout(self, p_action, n_episodes=1000, maxSteps=1000, greedy=False, seed=None):
+        """
+        Simulates n_episodes episodes under the policy p_action (action probabilities per state) at once.
+        Every episode ends in a terminal state, in a state without possible transitions or after maxSteps steps.
+        With greedy the most likely action of every state is taken instead of sampling the actions.
+
+        Returns the dict of arrays with one value per episode:
+            'states': the visited states as array of shape (n_episodes, maxSteps + 1), -1 after the episode ended,
+            'actions': the taken actions as array of shape (n_episodes, maxSteps), -1 after the episode ended,
+            'steps': the number of steps of the episode,
+            'reachedGoal': whether the episode ended in a terminal state.
+        """
+        rng = np.random.default_rng(seed)
+        p_action = np.asarray(p_action, dtype=np.float64)
+        actionCdf = np.cumsum(p_action, axis=1)
+
+        states = np.full((n_episodes, maxSteps + 1), -1, dtype=np.int64)
+        actions = np.full((n_episodes, maxSteps), -1, dtype=np.int64)
+        steps = np.zeros(n_episodes, dtype=np.int64)
+
+        current = np.minimum(np.searchsorted(self.initialCdf, rng.random(n_episodes) * self.initialCdf[-1],
+                                             side='right'), self.n_states - 1)
+        states[:, 0] = current
+        active = np.flatnonzero(~self.terminal[current])
+
+        for t in range(maxSteps):
+            if not len(active):
+                break
+            s = states[active, t]
+
+            # Sample the actions, states without any action probability take action 0
+            if greedy:
+                a = np.argmax(p_action[s], axis=1)
+            else:
+                u = rng.random(len(active)) * actionCdf[s, -1]
+                a = np.minimum((actionCdf[s] <= u[:, None]).sum(axis=1), self.n_actions - 1)
+                a[actionCdf[s, -1] == 0] = 0
+
+            # Episodes without possible transitions end
+            rows = s * self.n_actions + a
+            possible = self.rowSums[rows] > 0
+            active, rows, a = active[possible], rows[possible], a[possible]
+
+            position = np.searchsorted(self.shiftedCdf, rows + rng.random(len(active)), side='right')
+            next_s = self.nextStates[np.minimum(position, len(self.nextStates) - 1)]
+
+            actions[active, t] = a
+            states[active, t + 1] = next_s
+            steps[active] += 1
+            active = active[~self.terminal[next_s]]
+
+        last = states[np.arange(n_episodes), steps]
+        return {'states': states, 'actions': actions, 'steps': steps, 'reachedGoal': self.terminal[last]}
+
+    def evaluate(self, featureweights, n_episodes=1000, maxSteps=1000, greedy=False, seed=None,
+                 evaluationweights=None):
+        """
+        Simulates n_episodes episodes under the policy of the feature weights and returns the summary:
+        the fraction of episodes reaching the goal, the mean number of steps to the goal of these episodes,
+        the fraction of steps with a red traffic light in which the agent stops and the mean and standard
+        deviation of the return. The return is computed with evaluationweights, by default the feature weights.
+        """
+        result = self.rollout(self.policy(featureweights), n_episodes, maxSteps, greedy, seed)
+        states, actions, reached = result['states'], result['actions'], result['reachedGoal']
+
+        rewards = self.rewards(featureweights if evaluationweights is None else evaluationweights)
+        returns = np.where(states >= 0, rewards[np.maximum(states, 0)], 0.0).sum(axis=1)
+
+        redSteps = (actions >= 0) & self.lightIsRed[np.maximum(states[:, :-1], 0)]
+        n_red = np.count_nonzero(redSteps)
+
+        return {'episodes': n_episodes,
+                'reachedGoal': float(reached.mean()),
+                'stepsToGoal': float(result['steps'][reached].mean()) if reached.any() else np.nan,
+                'stopAtRed': float(np.count_nonzero(actions[redSteps] == 1) / n_red) if n_red else np.nan,
+                'meanReturn': float(returns.mean()),
+                'stdReturn': float(returns.std())}
+
+    def screen(self, weightList, **kwargs):
+        """
+        Evaluates every feature weight vector of weightList, see evaluate, and returns the results as dataframe
+        """
+        results = []
+        for featureweights in weightList:
+            result = {str(name): weight for name, weight in zip(self.stateTable.columns, featureweights)}
+            result.update(self.evaluate(featureweights, **kwargs))
+            results.append(result)
+        return pd.DataFrame(results)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Evaluate feature weights on the learned transition model')
+    argparser.add_argument(
+        '--weights',
+        nargs='+',
+        default=[16.28470795, -135.74640261],
+        type=float,
+        metavar='WEIGHT',
+        help='The feature weights of the evaluated reward function')
+    argparser.add_argument(
+        '-n', '--episodes',
+        default=5000,
+        type=int,
+        help='Number of simulated episodes')
+    argparser.add_argument(
+        '--max-steps',
+        default=1000,
+        type=int,
+        help='Maximum number of steps per episode')
+    argparser.add_argument(
+        '--greedy',
+        action='store_true',
+        help='Take the most likely action of the policy instead of sampling it')
+    argparser.add_argument(
+        '--seed',
+        default=None,
+        type=int,
+        help='Seed of the random number generator')
+    args = argparser.parse_args()
+
+    simulator = TabularSimulator.fromDemonstration(Demonstration())
+
+    start = time.perf_counter()
+    result = simulator.evaluate(args.weights, args.episodes, args.max_steps, args.greedy, args.seed)
+    print("Feature weights", args.weights)
+    for name, value in result.items():
+        print(name, value)
+    print("Simulated in", time.perf_counter() - start, "seconds")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,52 +1,63 @@
 import numpy as np
 import pandas as pd
 from DataFrameTrajectory import DataFrameTrajectory
+from stateIndex import StateIndex
 
 
 class Trajectory:
 
-    def __init__(self, df, stateTable):
+    def __init__(self, df, stateTable, stateIndex=None, stateNumbers=None):
+        """
+        stateIndex:     StateIndex of the stateTable. Provide it when creating many trajectories
+                        for the same stateTable, so the index is only built once.
+        stateNumbers:   The state number of every step of df, if these have already been looked up.
+        """
         self.featureNames = df.columns.values
+        self.stateIndex = stateIndex if stateIndex is not None else StateIndex(stateTable)
+
+        # The state number of every step of the trajectory
+        if stateNumbers is None:
+            stateNumbers = self.findStatesInStateTable(df.to_numpy(dtype=np.float64), stateTable)
+        elif (stateNumbers < 0).any():
+            unknown = df.to_numpy(dtype=np.float64)[np.argmax(stateNumbers < 0)]
+            raise KeyError("No state in the state table with features " + str(list(unknown[:2])))
 
         # The initial state for this trajectory
-        self.startState = self.findStateInStateTable(
-            df.iloc[0, :2].to_numpy(dtype=np.float64), stateTable)
+        self.startState = stateNumbers[0]
 
         # The terminal state for this trajectory
-        self.terminalState = self.findStateInStateTable(
-            df.iloc[-1, :2].to_numpy(dtype=np.float64), stateTable)
+        self.terminalState = stateNumbers[-1]
         
         # Transitions is a matrix with the transition observed during the trajectory
+        # transitionCount contains the number of times each of these transitions has been observed
         # stateVisitationFrequency contains the frequency that a state has been visited during this trajectory
-        self.transitions, self.stateVisitationFrequency = self.generateTrajectionTransition(
-            df, stateTable)
+        self.transitions, self.transitionCount, self.stateVisitationFrequency = self.generateTrajectionTransition(
+            df, stateTable, stateNumbers=stateNumbers)
 
-    def generateTrajectionTransition(self, dfTrajectory, stateTable, debug=False):
+    def generateTrajectionTransition(self, dfTrajectory, stateTable, debug=False, stateNumbers=None):
         # Returns matrix that contains the state,action,state' for every step,
         # with row 0 the intial state.
-        # Also returns state visitation frequencey for this trajectory.
+        # Also returns the number of times each transition is observed and
+        # the state visitation frequencey for this trajectory.
 
         steps = dfTrajectory.to_numpy(dtype=np.float64)
-        prevState = self.startState
-        prevAction = steps[0, 2]    
-        steps = np.delete(steps, 0, axis=0)
-        trajectoryTransition = np.empty((0, 3), dtype=int)
-
-        # Create a matrix that contains the (state, action, next-state) transition
-        for step in steps:
-            newState = self.findStateInStateTable(step[:2], stateTable)
-            trajectoryTransition = np.append(trajectoryTransition, np.array(
-                [[prevState, prevAction, newState]]), axis=0)
+        if stateNumbers is None:
+            stateNumbers = self.findStatesInStateTable(steps, stateTable)
+        actions = np.rint(steps[:, 2]).astype(np.int64)
 
-            prevState = newState
-            prevAction = step[2]
+        # Create a matrix that contains the (state, action, next-state) transition,
+        # the action performed in a step leads to the state of the next step
+        trajectoryTransition = np.column_stack(
+            (stateNumbers[:-1], actions[:-1], stateNumbers[1:]))
 
         vistedStates, stateVisitationFrequency = np.unique(
-            trajectoryTransition[:, 2], axis=0, return_counts=True)
+            trajectoryTransition[:, 2], return_counts=True)
 
-        # Add the visit of the initial state to the arrays
-        vistedStates = np.append([self.startState], vistedStates)
-        stateVisitationFrequency = np.append([1], stateVisitationFrequency)
+        # Add the visit of the initial state to the arrays, if the initial state is
+        # visited again later on its count of later visits is kept
+        if self.startState not in vistedStates:
+            vistedStates = np.append([self.startState], vistedStates)
+            stateVisitationFrequency = np.append([1], stateVisitationFrequency)
 
         trajectoryTransition, count = np.unique(
             trajectoryTransition, axis=0, return_counts=True)
@@ -61,10 +72,20 @@ class Trajectory:
                       "- endStateFeatures", stateTable.iloc[int(i[2])].tolist(), "count",  count[index])
             print("\n\n\n\n")
 
-        return trajectoryTransition, stateVisitationFrequency
+        return trajectoryTransition, count, stateVisitationFrequency
 
     def findStateInStateTable(self, state, stateTable):
-        return stateTable.loc[(stateTable['lightIsRed'] == (state[0])) & (stateTable['distanceToGoal'] == (state[1]))].index[0]
+        stateNumber = self.stateIndex.findState(state)
+        if stateNumber is None:
+            raise KeyError("No state in the state table with features " + str(list(state[:2])))
+        return stateNumber
+
+    def findStatesInStateTable(self, states, stateTable):
+        stateNumbers = self.stateIndex.findStates(states)
+        if (stateNumbers < 0).any():
+            unknown = states[np.argmax(stateNumbers < 0)]
+            raise KeyError("No state in the state table with features " + str(list(unknown[:2])))
+        return stateNumbers
 
 
 def main():
@@ -6,12 +6,186 @@ Based on the corresponding paper by B. Ziebart et al. (2008) and the Thesis
 by Ziebart (2010).
 """
 
+import warnings
+from collections import deque
+
 import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+from scipy.sparse import csgraph
+
+from transitionModel import SparseTransitionModel
 
 # -- common functions ----------------------------------------------------------
 
 
-def feature_expectation_from_trajectories(stateToFeatures, trajectories):
+class DivergenceError(ArithmeticError):
+    """
+    Raised by `irl` if the expected state visitation frequency of the current
+    policy does not converge, or the reward parameters become non-finite.
+
+    Attributes:
+        theta: The reward parameters of the last step.
+        delta_list: The parameter deltas of all steps before the divergence.
+    """
+    def __init__(self, message, theta, delta_list):
+        super().__init__(message)
+        self.theta = theta
+        self.delta_list = delta_list
+
+
+def transition_matrices(p_transition):
+    """
+    Split the transition probabilities into one matrix per action.
+
+    Args:
+        p_transition: The transition probabilities of the MDP, either as
+            dense table `[from: Integer, action: Integer, to: Integer]` or as
+            `SparseTransitionModel`.
+
+    Returns:
+        A list of `n_actions` matrices of shape `(n_states x n_states)`. The
+        matrices are sparse CSR matrices iff `p_transition` is sparse.
+    """
+    if isinstance(p_transition, SparseTransitionModel):
+        return list(p_transition.matrices)
+
+    return [np.array(p_transition[:, a, :]) for a in range(p_transition.shape[1])]
+
+
+def log_matrix(p):
+    """
+    Convert a (sparse or dense) matrix into its sparse log-space form.
+
+    Args:
+        p: The matrix of shape `(n_states x n_states)` with non-negative
+            entries.
+
+    Returns:
+        A CSR matrix with the same sparsity structure as the non-zero
+        entries of `p`, storing the logarithm of these entries. This is the
+        form expected by `log_dot`.
+    """
+    log_p = sp.csr_matrix(p, dtype=np.float64, copy=True)
+    log_p.eliminate_zeros()
+    log_p.sort_indices()
+    log_p.data = np.log(log_p.data)
+    return log_p
+
+
+def log_dot(log_p, log_x):
+    """
+    Compute `log(p.dot(exp(log_x)))` without leaving log-space.
+
+    Every row is shifted by the maximum of its terms before exponentiating,
+    so that neither overflow nor underflow occurs for (log-)values of very
+    different magnitude.
+
+    Args:
+        log_p: The matrix `p` in log-space, as returned by `log_matrix`.
+        log_x: The logarithm of the vector to multiply with, `-np.inf`
+            representing zero. A batch of vectors may be given as array of
+            shape `(n_batch, n_states)`.
+
+    Returns:
+        The logarithm of the matrix-vector product as vector of shape
+        `(n_states,)`, respectively `(n_batch, n_states)` for a batch of
+        vectors, `-np.inf` representing zero.
+    """
+    nonempty = np.diff(log_p.indptr) > 0
+    starts = log_p.indptr[:-1][nonempty]
+
+    result = np.full(log_x.shape[:-1] + (log_p.shape[0],), -np.inf)
+    if not starts.size:
+        return result
+
+    terms = log_p.data + log_x[..., log_p.indices]
+
+    shift = np.maximum.reduceat(terms, starts, axis=-1)
+    shift = np.where(np.isfinite(shift), shift, 0.0)
+
+    with np.errstate(divide='ignore'):
+        shifted = np.exp(terms - np.repeat(shift, np.diff(log_p.indptr)[nonempty], axis=-1))
+        result[..., nonempty] = shift + np.log(np.add.reduceat(shifted, starts, axis=-1))
+    return result
+
+
+def longest_acyclic_path(p_transition):
+    """
+    Compute an upper bound on the number of states on any acyclic path of
+    the MDP.
+
+    The transition graph is condensed into its strongly connected components,
+    which yields a directed acyclic graph. The longest path in this graph,
+    where every component counts with its number of states, bounds the
+    length of every path visiting each state at most once.
+
+    Args:
+        p_transition: The transition probabilities of the MDP, either as
+            dense table `[from: Integer, action: Integer, to: Integer]` or as
+            `SparseTransitionModel`.
+
+    Returns:
+        The upper bound on the number of states on an acyclic path as
+        Integer.
+    """
+    n_states, _, _ = p_transition.shape
+    if n_states == 0:
+        return 0
+
+    adjacency = sum(sp.csr_matrix(p) for p in transition_matrices(p_transition))
+    adjacency = sp.coo_matrix(adjacency)
+
+    n_components, labels = csgraph.connected_components(
+        adjacency, directed=True, connection='strong')
+    sizes = np.bincount(labels, minlength=n_components)
+
+    # edges of the condensed graph, self-loops of components are removed
+    src, dst = labels[adjacency.row], labels[adjacency.col]
+    keep = (src != dst) & (adjacency.data != 0)
+    dag = sp.csr_matrix((np.ones(np.count_nonzero(keep)), (src[keep], dst[keep])),
+                        shape=(n_components, n_components))
+
+    # longest path via Kahn's topological ordering
+    in_degree = np.diff(sp.csc_matrix(dag).indptr)
+    length = sizes.copy()
+    queue = deque(np.flatnonzero(in_degree == 0))
+    while queue:
+        c = queue.popleft()
+        for successor in dag.indices[dag.indptr[c]:dag.indptr[c + 1]]:
+            length[successor] = max(length[successor], length[c] + sizes[successor])
+            in_degree[successor] -= 1
+            if in_degree[successor] == 0:
+                queue.append(successor)
+
+    return int(length.max())
+
+
+def state_visitation_count(n_states, trajectories):
+    """
+    Count the number of visits to each state over all given trajectories.
+
+    Args:
+        n_states: The number of states.
+        trajectories: A list or iterator of `Trajectory` instances.
+
+    Returns:
+        The total number of visits as map
+        `[state: Integer] -> count: Float`.
+    """
+    states, counts = [], []
+    for t in trajectories:
+        states.append(np.fromiter(t.stateVisitationFrequency.keys(), dtype=np.int64))
+        counts.append(np.fromiter(t.stateVisitationFrequency.values(), dtype=np.float64))
+
+    if not states:
+        return np.zeros(n_states)
+
+    return np.bincount(np.concatenate(states), weights=np.concatenate(counts),
+                       minlength=n_states)
+
+
+def feature_expectation_from_trajectories(stateToFeatures, trajectories, visitation_count=None):
     """
     Compute the feature expectation of the given trajectories.
 
@@ -22,20 +196,18 @@ def feature_expectation_from_trajectories(stateToFeatures, trajectories):
         features: The feature-matrix (e.g. as numpy array), mapping states
             to features, i.e. a matrix of shape (n_states x n_features).
         trajectories: A list or iterator of `Trajectory` instances.
+        visitation_count: The number of visits to each state over all
+            trajectories, as returned by `state_visitation_count`. Computed
+            from the trajectories if not provided.
 
     Returns:
         The feature-expectation of the provided trajectories as map
         `[state: Integer] -> feature_expectation: Float`.
     """
-    n_features = stateToFeatures.shape[1]
+    if visitation_count is None:
+        visitation_count = state_visitation_count(stateToFeatures.shape[0], trajectories)
 
-    fe = np.zeros(n_features)
-    for t in trajectories:
-        for state, freq in t.stateVisitationFrequency.items():
-            for _ in range(freq):
-                fe += stateToFeatures[int(state)]
-
-    return fe / len(trajectories)
+    return stateToFeatures.T.dot(visitation_count) / len(trajectories)
 
 
 def initial_probabilities_from_trajectories(n_states, trajectories):
@@ -59,7 +231,82 @@ def initial_probabilities_from_trajectories(n_states, trajectories):
     return p / len(trajectories)
 
 
-def expected_svf_from_policy(p_transition, p_initial, terminal, p_action, eps=1e-5):
+def policy_transition_matrix(p_transition, terminal, p_action):
+    """
+    Compute the state transition matrix induced by the given local action
+    probabilities.
+
+    Transitions from terminal states are removed, i.e. the corresponding
+    rows of the returned matrix are zero.
+
+    Args:
+        p_transition: The transition probabilities of the MDP as table
+            `[from: Integer, action: Integer, to: Integer] -> probability: Float`
+            specifying the probability of a transition from state `from` to
+            state `to` via action `action` to succeed. This may either be a
+            dense numpy array or a `SparseTransitionModel`.
+        terminal: A list of terminal states.
+        p_action: Local action probabilities as map
+            `[state: Integer, action: Integer] -> probability: Float`
+            as returned by `local_action_probabilities`, or a batch of them
+            as map `[run: Integer, state: Integer, action: Integer]`.
+
+    Returns:
+        The matrix `[from: Integer, to: Integer] -> probability: Float` of
+        shape `(n_states x n_states)`. It is a CSR matrix iff `p_transition`
+        is sparse. For a batch of policies, a dense stack of shape
+        `(n_runs x n_states x n_states)` is returned, respectively a sparse
+        block-diagonal matrix with one `(n_states x n_states)` block per run.
+    """
+    n_states, _, _ = p_transition.shape
+
+    # we will _never_ leave any terminal state
+    weights = np.array(p_action, dtype=np.float64)
+    weights[..., list(terminal), :] = 0.0
+
+    if isinstance(p_transition, SparseTransitionModel):
+        blocks = []
+        for w in np.reshape(weights, (-1,) + weights.shape[-2:]):
+            p_policy = sp.csr_matrix((n_states, n_states))
+            for a, p in enumerate(p_transition.matrices):
+                p_policy = p_policy + sp.diags(w[:, a]).dot(p)
+            blocks.append(p_policy)
+
+        if weights.ndim == 2:
+            return sp.csr_matrix(blocks[0])
+        return sp.block_diag(blocks, format='csr')
+
+    return np.einsum('...sa,sat->...st', weights, p_transition)
+
+
+def log_likelihood(p_action, trajectories):
+    """
+    Compute the average log-likelihood of the demonstrated actions under the
+    given local action probabilities.
+
+    Args:
+        p_action: Local action probabilities as map
+            `[state: Integer, action: Integer] -> probability: Float`
+            as returned by `local_action_probabilities`, or a batch of them
+            as map `[run: Integer, state: Integer, action: Integer]`.
+        trajectories: A list of `Trajectory` instances representing the
+            expert demonstrations.
+
+    Returns:
+        The log-likelihood per trajectory as Float, respectively one value
+        per run for a batch of policies.
+    """
+    transitions = np.concatenate([t.transitions for t in trajectories]).astype(np.int64)
+    counts = np.concatenate([t.transitionCount for t in trajectories])
+
+    with np.errstate(divide='ignore'):
+        log_p = np.log(p_action[..., transitions[:, 0], transitions[:, 1]])
+
+    return log_p.dot(counts) / len(trajectories)
+
+
+def expected_svf_from_policy(p_transition, p_initial, terminal, p_action, eps=1e-5, direct=False,
+                             max_iter=100000):
     """
     Compute the expected state visitation frequency using the given local
     action probabilities.
@@ -75,46 +322,148 @@ def expected_svf_from_policy(p_transition, p_initial, terminal, p_action, eps=1e
         p_transition: The transition probabilities of the MDP as table
             `[from: Integer, action: Integer, to: Integer] -> probability: Float`
             specifying the probability of a transition from state `from` to
-            state `to` via action `action` to succeed.
+            state `to` via action `action` to succeed. This may either be a
+            dense numpy array or a `SparseTransitionModel`.
         p_initial: The probability of a state being an initial state as map
             `[state: Integer] -> probability: Float`.
         terminal: A list of terminal states.
         p_action: Local action probabilities as map
             `[state: Integer, action: Integer] -> probability: Float`
-            as returned by `local_action_probabilities`.
+            as returned by `local_action_probabilities`. A batch of policies
+            may be given as map `[run: Integer, state: Integer, action: Integer]`,
+            in which case the frequencies of all runs are computed at once.
         eps: The threshold to be used as convergence criterion. Convergence
             is assumed if the expected state visitation frequency changes
-            less than the threshold on all states in a single iteration.
+            less than the threshold, relative to its largest value (or
+            absolutely, if all values are below 1), on all states in a
+            single iteration.
+        direct: If `True`, the fixed point is computed by directly solving
+            the linear system `(I - P_pi^T) d = p_initial` instead of
+            iterating. This requires the policy to eventually leave every
+            non-terminal state. If the system of a policy is singular, or its
+            frequencies sum to more than `max_iter` times the initial mass,
+            they are `np.inf`, as for a policy that does not converge.
+        max_iter: The maximum number of iterations. A policy that does not
+            (or only very slowly) leave the non-terminal states does not
+            converge within this bound.
 
     Returns:
         The expected state visitation frequencies as map
-        `[state: Integer] -> svf: Float`.
+        `[state: Integer] -> svf: Float`, respectively
+        `[run: Integer, state: Integer]` for a batch of policies. The
+        frequencies of a policy that did not converge are `np.inf`.
     """
-    n_states, n_actions, _ = p_transition.shape
+    n_states, _, _ = p_transition.shape
+    shape = np.shape(p_action)[:-1]
 
-    # 'fix' our transition probabilities to allow for convergence
-    # we will _never_ leave any terminal state
-    p_transition = np.copy(p_transition)
-    p_transition[list(terminal), :, :] = 0.0
+    # the policy-weighted transition operator, formed once for all iterations
+    p_policy = policy_transition_matrix(p_transition, terminal, p_action)
 
-    # set-up transition matrices for each action
-    p_transition = [np.array(p_transition[:, a, :]) for a in range(n_actions)]
-    # actual forward-computation of state expectations
-    d = np.zeros(n_states)
+    if sp.issparse(p_policy):
+        # batches are handled by a block-diagonal operator on the flattened frequencies
+        p_policy_t = sp.csr_matrix(p_policy.T)
+        p_initial = np.tile(p_initial, int(np.prod(shape[:-1])))
 
-    delta = np.inf
-    while delta > eps:
-        d_ = [p_transition[a].T.dot(p_action[:, a] * d)
-              for a in range(n_actions)]
-        d_ = p_initial + np.array(d_).sum(axis=0)
+        def step(d):
+            return p_initial + p_policy_t.dot(d)
+    else:
+        p_policy_t = np.swapaxes(p_policy, -1, -2)
+        p_initial = np.broadcast_to(p_initial, shape)
+
+        def step(d):
+            return p_initial + np.matmul(p_policy_t, d[..., None])[..., 0]
+
+    if direct:
+        d = solve_expected_svf(p_policy_t, p_initial, n_states).reshape(-1, n_states)
+        # every iteration adds at most the initial mass, a policy whose chain
+        # holds more visits could not converge within max_iter iterations and
+        # its (ill-conditioned) solution is not trusted either
+        mass = np.reshape(p_initial, (-1, n_states)).sum(axis=1)
+        with np.errstate(invalid='ignore'):
+            d[d.sum(axis=1) > max_iter * mass] = np.inf
+        return d.reshape(shape)
+
+    # actual forward-computation of state expectations, checked per run
+    d = np.zeros(p_initial.shape)
+
+    converged = np.zeros(int(np.prod(shape[:-1])), dtype=bool)
+    diverged = np.zeros_like(converged)
+    for _ in range(max_iter):
+        with np.errstate(over='ignore', invalid='ignore'):
+            d_ = step(d)
+            runs, runs_ = d.reshape(-1, n_states), d_.reshape(-1, n_states)
+            scale = np.maximum(np.max(np.abs(runs_), axis=1), 1.0)
+            converged = np.max(np.abs(runs_ - runs), axis=1) <= eps * scale
+        diverged = ~np.all(np.isfinite(runs_), axis=1)
+        d = d_
+
+        if np.all(converged | diverged):
+            break
+
+    d = np.array(d, dtype=np.float64).reshape(-1, n_states)
+    d[~converged] = np.inf
+    return d.reshape(shape)
+
+
+def solve_expected_svf(p_policy_t, p_initial, n_states=None):
+    """
+    Directly solve for the expected state visitation frequency of an
+    absorbing chain.
 
-        delta, d = np.max(np.abs(d_ - d)), d_
-    return d
+    Args:
+        p_policy_t: The transposed policy transition matrix as returned by
+            `policy_transition_matrix`, either sparse or dense. A dense
+            stack of matrices, respectively a sparse block-diagonal matrix,
+            is solved for each run.
+        p_initial: The probability of a state being an initial state as map
+            `[state: Integer] -> probability: Float`, respectively one such
+            map per run (flattened for a sparse block-diagonal matrix).
+        n_states: The number of states, i.e. the size of the blocks of a
+            sparse block-diagonal matrix. Defaults to the size of the matrix.
+
+    Returns:
+        The expected state visitation frequencies as map
+        `[state: Integer] -> svf: Float`, respectively one map per run. The
+        frequencies of a run whose chain is not absorbing, and whose system
+        can thus not be solved, are `np.inf`.
+    """
+    if n_states is None:
+        n_states = p_policy_t.shape[-1]
+
+    if sp.issparse(p_policy_t):
+        # solve every block of a block-diagonal batch on its own
+        p_policy_t = sp.csr_matrix(p_policy_t)
+        d = np.empty(p_policy_t.shape[-1])
+        for begin in range(0, p_policy_t.shape[-1], n_states):
+            end = begin + n_states
+            system = sp.csc_matrix(sp.identity(n_states) - p_policy_t[begin:end, begin:end])
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', spla.MatrixRankWarning)
+                    d[begin:end] = spla.spsolve(system, p_initial[begin:end])
+            except RuntimeError:
+                d[begin:end] = np.inf
+    else:
+        system = np.identity(n_states) - p_policy_t
+        try:
+            d = np.linalg.solve(system, p_initial[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            # solve the runs one by one to find the singular ones
+            d = np.empty(p_initial.shape)
+            for k in np.ndindex(p_initial.shape[:-1]):
+                try:
+                    d[k] = np.linalg.solve(system[k], p_initial[k])
+                except np.linalg.LinAlgError:
+                    d[k] = np.inf
+
+    runs = np.array(d, dtype=np.float64).reshape(-1, n_states)
+    runs[~np.all(np.isfinite(runs), axis=1)] = np.inf
+    return runs.reshape(np.shape(d))
 
 
 # -- plain maximum entropy (Ziebart et al. 2008) -------------------------------
 
-def local_action_probabilities(p_transition, terminal, reward):
+def local_action_probabilities(p_transition, terminal, reward, eps=1e-10, horizon=None):
     """
     Compute the local action probabilities (policy) required for the edge
     frequency calculation for maximum entropy reinfocement learning.
@@ -122,44 +471,79 @@ def local_action_probabilities(p_transition, terminal, reward):
     This is the backward pass of Algorithm 1 of the Maximum Entropy IRL
     paper by Ziebart et al. (2008).
 
+    The pass is performed on the log partition functions, so that it stays
+    numerically stable for large (negative) rewards.
+
     Args:
         p_transition: The transition probabilities of the MDP as table
-            `[from: Integer, to: Integer, action: Integer] -> probability: Float`
+            `[from: Integer, action: Integer, to: Integer] -> probability: Float`
             specifying the probability of a transition from state `from` to
-            state `to` via action `action` to succeed.
+            state `to` via action `action` to succeed. This may either be a
+            dense numpy array or a `SparseTransitionModel`.
         terminal: A set/list of terminal states.
         reward: The reward signal per state as table
-            `[state: Integer] -> reward: Float`.
+            `[state: Integer] -> reward: Float`. A batch of reward signals
+            may be given as table `[run: Integer, state: Integer]`, in
+            which case the policies of all runs are computed at once.
+        eps: The threshold to be used as convergence criterion for the state
+            log partition function. Convergence is assumed if the
+            (normalized) state log partition function changes less than the
+            threshold on all states in a single iteration.
+        horizon: The maximum number of iterations. Defaults to four times
+            the longest acyclic path of the MDP (see `longest_acyclic_path`),
+            which is at most the fixed number of iterations (four times the
+            number of states) of the original (linear-space) backward pass.
 
     Returns:
         The local action probabilities (policy) as map
-        `[state: Integer, action: Integer] -> probability: Float`
+        `[state: Integer, action: Integer] -> probability: Float`,
+        respectively `[run: Integer, state: Integer, action: Integer]` for a
+        batch of reward signals.
     """
     n_states, n_actions, _ = p_transition.shape
- 
-    er = np.exp(reward)
+    rewards = np.atleast_2d(reward)
+
+    if horizon is None:
+        horizon = 4 * longest_acyclic_path(p_transition)
 
-   
-    p = [np.array(p_transition[:, a, :]) for a in range(n_actions)]
+    log_p = [log_matrix(p) for p in transition_matrices(p_transition)]
 
     # initialize at terminal states
-    zs = np.zeros(n_states)
-    zs[list(terminal)] = 1.0
+    log_zs = np.full(rewards.shape, -np.inf)
+    log_zs[:, list(terminal)] = 0.0
 
     # perform backward pass
-    # This does not converge, instead we iterate a fixed number of steps. The
-    # number of steps is chosen to reflect the maximum steps required to
-    # guarantee propagation from any state to any other state and back in an
-    # arbitrary MDP defined by p_transition.
-    for _ in range(4 * n_states):
-        za = np.array([er * p[a].dot(zs) for a in range(n_actions)]).T
-        zs = za.sum(axis=1)
+    # The partition functions themselves do not converge, they either grow or
+    # decay geometrically. The policy only depends on their ratios, so after
+    # each step we shift them by a constant and check the shifted values for
+    # convergence. The number of steps is bounded by the horizon, chosen to
+    # reflect the steps required for propagation from any state to any other
+    # state and back in the MDP defined by p_transition.
+    log_za = np.full(rewards.shape + (n_actions,), -np.inf)
+    for _ in range(horizon):
+        log_za = np.stack([rewards + log_dot(log_p[a], log_zs) for a in range(n_actions)], axis=-1)
+        log_zs_new = np.logaddexp.reduce(log_za, axis=-1)
+
+        finite = np.isfinite(log_zs_new)
+        shift = np.max(np.where(finite, log_zs_new, -np.inf), axis=1, keepdims=True)
+        log_zs_new = log_zs_new - np.where(np.isfinite(shift), shift, 0.0)
+
+        converged = np.array_equal(finite, np.isfinite(log_zs)) \
+            and np.max(np.abs(log_zs_new[finite] - log_zs[finite]), initial=0.0) < eps
+        log_zs = log_zs_new
+
+        if converged:
+            break
 
-    value =  np.divide(za, zs[:, None], out=np.zeros_like(za), where=zs[:, None]!=0)
-    return value
+    with np.errstate(invalid='ignore'):
+        value = np.exp(log_za - np.logaddexp.reduce(log_za, axis=-1)[..., None])
+    value = np.nan_to_num(value, nan=0.0)
 
+    return value if np.ndim(reward) == 2 else value[0]
 
-def compute_expected_svf(p_transition, p_initial, terminal, reward, eps=1e-5):
+
+def compute_expected_svf(p_transition, p_initial, terminal, reward, eps=1e-5,
+                         eps_lap=1e-10, horizon=None, direct=False):
     """
     Compute the expected state visitation frequency for maximum entropy IRL.
 
@@ -172,9 +556,10 @@ def compute_expected_svf(p_transition, p_initial, terminal, reward, eps=1e-5):
 
     Args:
         p_transition: The transition probabilities of the MDP as table
-            `[from: Integer, to: Integer, action: Integer] -> probability: Float`
+            `[from: Integer, action: Integer, to: Integer] -> probability: Float`
             specifying the probability of a transition from state `from` to
-            state `to` via action `action` to succeed.
+            state `to` via action `action` to succeed. This may either be a
+            dense numpy array or a `SparseTransitionModel`.
         p_initial: The probability of a state being an initial state as map
             `[state: Integer] -> probability: Float`.
         terminal: A list of terminal states.
@@ -184,17 +569,24 @@ def compute_expected_svf(p_transition, p_initial, terminal, reward, eps=1e-5):
             expected state-visitation frequency. Convergence is assumed if
             the expected state visitation frequency changes less than the
             threshold on all states in a single iteration.
+        eps_lap: The threshold to be used as convergence criterion for the
+            state log partition function. See `local_action_probabilities`.
+        horizon: The maximum number of iterations of the backward pass. See
+            `local_action_probabilities`.
+        direct: Whether to solve for the expected state visitation
+            frequency directly. See `expected_svf_from_policy`.
 
     Returns:
         The expected state visitation frequencies as map
         `[state: Integer] -> svf: Float`.
     """
-    p_action = local_action_probabilities(p_transition, terminal, reward)
+    p_action = local_action_probabilities(p_transition, terminal, reward, eps_lap, horizon)
 
-    return expected_svf_from_policy(p_transition, p_initial, terminal, p_action, eps)
+    return expected_svf_from_policy(p_transition, p_initial, terminal, p_action, eps, direct)
 
 
-def irl(p_transition, stateToFeatures, terminal, trajectories, optim, init, eps=1e-8, eps_esvf=1e-10):
+def irl(p_transition, stateToFeatures, terminal, trajectories, optim, init, eps=1e-8, eps_esvf=1e-10,
+        eps_lap=1e-10, direct_svf=False, visitation_count=None, max_steps=None, horizon=None):
     """
     Compute the reward signal given the demonstration trajectories using the
     maximum entropy inverse reinforcement learning algorithm proposed in the
@@ -202,9 +594,10 @@ def irl(p_transition, stateToFeatures, terminal, trajectories, optim, init, eps=
 
     Args:
         p_transition: The transition probabilities of the MDP as table
-            `[from: Integer, to: Integer, action: Integer] -> probability: Float`
+            `[from: Integer, action: Integer, to: Integer] -> probability: Float`
             specifying the probability of a transition from state `from` to
-            state `to` via action `action` to succeed.
+            state `to` via action `action` to succeed. This may either be a
+            dense numpy array or a `SparseTransitionModel`.
         features: The feature-matrix (e.g. as numpy array), mapping states
             to features, i.e. a matrix of shape (n_states x n_features).
         terminal: A list of terminal states.
@@ -222,9 +615,27 @@ def irl(p_transition, stateToFeatures, terminal, trajectories, optim, init, eps=
             expected state-visitation frequency. Convergence is assumed if
             the expected state visitation frequency changes less than the
             threshold on all states in a single iteration.
+        eps_lap: The threshold to be used as convergence criterion for the
+            state log partition function. Convergence is assumed if the
+            state log partition function changes less than the threshold on
+            all states in a single iteration.
+        direct_svf: Whether to solve for the expected state-visitation
+            frequency directly instead of iterating. See
+            `expected_svf_from_policy`.
+        visitation_count: The number of visits to each state over all
+            trajectories. See `feature_expectation_from_trajectories`.
+        max_steps: The maximum number of optimization steps, or `None` to
+            optimize until convergence.
+        horizon: The maximum number of iterations of the backward pass, or
+            `None` for four times the longest acyclic path of the MDP. See
+            `local_action_probabilities`.
 
     Returns:
         The reward per state as table `[state: Integer] -> reward: Float`.
+
+    Raises:
+        DivergenceError: If the expected state visitation frequency of a
+            step does not converge or the parameters become non-finite.
     """
     delta_list = []
     theta_list = [[],[]]
@@ -238,10 +649,14 @@ def irl(p_transition, stateToFeatures, terminal, trajectories, optim, init, eps=
 
     # compute static properties from trajectories
     e_features = feature_expectation_from_trajectories(
-        stateToFeatures.to_numpy(), trajectories)
+        stateToFeatures.to_numpy(), trajectories, visitation_count)
     
     p_initial = initial_probabilities_from_trajectories(n_states, trajectories)
 
+    # the iteration bound of the backward pass only depends on the MDP
+    if horizon is None:
+        horizon = 4 * longest_acyclic_path(p_transition)
+
     # basic gradient descent
     theta = init(n_features)
     theta_list[0].append(theta[0])
@@ -249,14 +664,17 @@ def irl(p_transition, stateToFeatures, terminal, trajectories, optim, init, eps=
     delta = np.inf
 
     optim.reset(theta)
-    while delta > eps:
+    while delta > eps and (max_steps is None or len(delta_list) < max_steps):
         theta_old = theta.copy()
         # compute per-state reward
         reward = stateFeatureMatrix.dot(theta)
 
         # compute the gradient
         e_svf = compute_expected_svf(
-            p_transition, p_initial, terminal, reward, eps_esvf)
+            p_transition, p_initial, terminal, reward, eps_esvf, eps_lap, horizon, direct_svf)
+        if not np.all(np.isfinite(e_svf)):
+            raise DivergenceError("Expected state visitation frequency does not converge for parameters "
+                                  + str(theta), theta, delta_list)
         
         # print(e_features, "vs", stateFeatureMatrix.T.dot(e_svf))
         # print(stateFeatureMatrix.T.dot(e_svf))
@@ -264,6 +682,8 @@ def irl(p_transition, stateToFeatures, terminal, trajectories, optim, init, eps=
         
         # perform optimization step and compute delta for convergence
         optim.step(grad)
+        if not np.all(np.isfinite(theta)):
+            raise DivergenceError("Parameters diverged to " + str(theta), theta, delta_list)
         delta = np.max(np.abs(theta_old - theta))
         delta_list.append(delta)
         theta_list[0].append(theta[0])
@@ -274,6 +694,130 @@ def irl(p_transition, stateToFeatures, terminal, trajectories, optim, init, eps=
     return stateFeatureMatrix.dot(theta), delta_list, theta_list
 
 
+def irl_batch(p_transition, stateToFeatures, terminal, trajectories, optims, inits, eps=1e-8,
+              eps_esvf=1e-10, eps_lap=1e-10, direct_svf=False, visitation_count=None, max_steps=None,
+              horizon=None):
+    """
+    Run multiple instances of `irl` at once, e.g. to compare different
+    initializations or optimizer configurations.
+
+    The backward and forward passes of all runs that have not converged yet
+    are computed together on stacked `(n_runs x n_states)` arrays. Each run
+    stops on its own once its parameters converge, or once it diverges, i.e.
+    its expected state visitation frequency does not converge or its
+    parameters become non-finite (see `DivergenceError`).
+
+    Args:
+        p_transition: The transition probabilities of the MDP as table
+            `[from: Integer, action: Integer, to: Integer] -> probability: Float`
+            specifying the probability of a transition from state `from` to
+            state `to` via action `action` to succeed. This may either be a
+            dense numpy array or a `SparseTransitionModel`.
+        features: The feature-matrix (e.g. as numpy array), mapping states
+            to features, i.e. a matrix of shape (n_states x n_features).
+        terminal: A list of terminal states.
+        trajectories: A list of `Trajectory` instances representing the
+            expert demonstrations.
+        optims: A list of `Optimizer` instances, one per run. Every run needs
+            its own instance as optimizers are stateful.
+        inits: The initial reward function parameters. Either a single
+            `Initializer` which is called once per run, a list of
+            `Initializer`s (one per run), or an array of shape
+            `(n_runs x n_features)`.
+        eps: The threshold to be used as convergence criterion for the
+            reward parameters of each run. See `irl`.
+        eps_svf: The threshold to be used as convergence criterion for the
+            expected state-visitation frequency. See `irl`.
+        eps_lap: The threshold to be used as convergence criterion for the
+            state log partition function. See `irl`.
+        direct_svf: Whether to solve for the expected state-visitation
+            frequency directly. See `irl`.
+        visitation_count: The number of visits to each state over all
+            trajectories. See `feature_expectation_from_trajectories`.
+        max_steps: The maximum number of optimization steps per run, or
+            `None` to optimize until convergence. See `irl`.
+        horizon: The maximum number of iterations of the backward pass. See
+            `irl`.
+
+    Returns:
+        A tuple `(rewards, delta_lists, likelihoods, best, diverged)` with
+        the reward per run and state as table `[run: Integer, state: Integer]`
+        (of the last finite parameters of a diverged run), the list of
+        parameter deltas per run, the final log-likelihood of the
+        demonstrations per run (see `log_likelihood`, `-np.inf` for diverged
+        runs), the index of the run with the highest likelihood and whether
+        each run diverged.
+    """
+    stateFeatureMatrix = stateToFeatures.to_numpy()
+    stateFeatureMatrix = stateFeatureMatrix[:, :4]
+
+    n_states, _, _ = p_transition.shape
+    n_features = stateToFeatures.shape[1]
+    n_runs = len(optims)
+
+    # compute static properties from trajectories
+    e_features = feature_expectation_from_trajectories(
+        stateToFeatures.to_numpy(), trajectories, visitation_count)
+    p_initial = initial_probabilities_from_trajectories(n_states, trajectories)
+    if horizon is None:
+        horizon = 4 * longest_acyclic_path(p_transition)
+
+    # stacked parameters, each optimizer works on its own row (view)
+    if callable(inits):
+        theta = np.array([inits(n_features) for _ in range(n_runs)], dtype=np.float64)
+    elif len(inits) and callable(inits[0]):
+        theta = np.array([init(n_features) for init in inits], dtype=np.float64)
+    else:
+        theta = np.array(inits, dtype=np.float64)
+
+    for k, optim in enumerate(optims):
+        optim.reset(theta[k])
+
+    delta_lists = [[] for _ in range(n_runs)]
+    active = np.ones(n_runs, dtype=bool)
+    diverged = np.zeros(n_runs, dtype=bool)
+    # the last finite parameters of every run
+    theta_final = theta.copy()
+    steps = 0
+    while active.any() and (max_steps is None or steps < max_steps):
+        runs = np.flatnonzero(active)
+        theta_old = theta[runs].copy()
+
+        # compute per-state reward of all active runs
+        reward = theta[runs].dot(stateFeatureMatrix.T)
+
+        # compute the gradients
+        e_svf = compute_expected_svf(
+            p_transition, p_initial, terminal, reward, eps_esvf, eps_lap, horizon, direct_svf)
+        finite = np.all(np.isfinite(e_svf), axis=1)
+        grad = e_features - np.where(finite[:, None], e_svf, 0.0).dot(stateFeatureMatrix)
+
+        # perform optimization steps and compute deltas for convergence,
+        # runs whose frequencies or parameters are not finite are stopped
+        for i, k in enumerate(runs):
+            if not finite[i]:
+                diverged[k], active[k] = True, False
+                continue
+            optims[k].step(grad[i])
+            if not np.all(np.isfinite(theta[k])):
+                diverged[k], active[k] = True, False
+                continue
+            theta_final[k] = theta[k]
+            delta = np.max(np.abs(theta_old[i] - theta[k]))
+            delta_lists[k].append(delta)
+            active[k] = delta > eps
+        steps += 1
+
+    rewards = theta_final.dot(stateFeatureMatrix.T)
+
+    likelihoods = np.full(n_runs, -np.inf)
+    if not diverged.all():
+        p_action = local_action_probabilities(p_transition, terminal, rewards[~diverged], eps_lap, horizon)
+        likelihoods[~diverged] = log_likelihood(p_action, trajectories)
+
+    return rewards, delta_lists, likelihoods, int(np.argmax(likelihoods)), diverged
+
+
 # -- maximum causal entropy (Ziebart 2010) -------------------------------------
 
 def softmax(x1, x2):
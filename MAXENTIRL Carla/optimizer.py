@@ -339,15 +339,19 @@ class Uniform(Initializer):
     Args:
         low: The minimum value of the distribution.
         high: The maximum value of the distribution
+        rng: The `numpy.random.Generator` to draw the parameters from, or
+            `None` to use the global `numpy.random` state.
 
     Attributes:
         low: The minimum value of the distribution.
         high: The maximum value of the distribution
+        rng: The random number generator, or `None`.
     """
-    def __init__(self, low=0.0, high=1.0):
+    def __init__(self, low=0.0, high=1.0, rng=None):
         super().__init__()
         self.low = low
         self.high = high
+        self.rng = rng
 
     def initialize(self, shape):
         """
@@ -363,7 +367,8 @@ class Uniform(Initializer):
             An set of initial uniformly distributed parameters of the given
             shape.
         """
-        return np.random.uniform(size=shape, low=self.low, high=self.high)
+        rng = self.rng if self.rng is not None else np.random
+        return rng.uniform(size=shape, low=self.low, high=self.high)
 
 
 class Constant(Initializer):
@@ -0,0 +1,115 @@
+"""
+Versioned binary file holding the learned reward model for the CARLA agent.
+
+The reward model file (`rewardModel.irl`) is written by carlaMaxIRL and holds
+everything the IRL agent needs to take its decisions: the feature weights,
+the state table and state index, the transition model and the precomputed
+state-action values and policy. The file starts with a fixed header
+
+    magic (8 bytes) | format version (uint32) | header length (uint32) | header (json)
+
+where the json header holds the metadata of the model and the dtype, shape and
+offset of every array. The arrays are stored after the header, aligned to 64
+bytes, so every array can be memory mapped without reading the whole file.
+
+The file is written to a temporary file first and then renamed, so a reader
+never sees a partially written model. On Windows a file cannot be replaced
+while it is memory mapped, so there the arrays are read into memory by default.
+"""
+
+import json
+import os
+import struct
+import time
+import numpy as np
+
+MAGIC = b"IRLMODEL"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+_prefix = struct.Struct("<8sII")
+
+
+def writeRewardModel(fileName, arrays, metadata=None):
+    """
+    Writes the arrays (dict from name to array) and metadata (json serializable dict) to the reward model file.
+    The model version is increased with every write of the same file.
+    """
+    metadata = dict(metadata or {})
+    metadata["modelVersion"] = readModelVersion(fileName) + 1
+    metadata["created"] = time.time()
+
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+
+    # The offsets are relative to the start of the data section, which follows the header
+    entries = dict()
+    offset = 0
+    for name, array in arrays.items():
+        entries[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    header = json.dumps({"metadata": metadata, "arrays": entries}).encode("utf-8")
+    dataStart = -(-(_prefix.size + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    temporaryFile = fileName + ".tmp"
+    with open(temporaryFile, "wb") as f:
+        f.write(_prefix.pack(MAGIC, FORMAT_VERSION, len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(dataStart + entries[name]["offset"])
+            f.write(array.tobytes())
+        f.truncate(dataStart + offset)
+    os.replace(temporaryFile, fileName)
+    return metadata
+
+
+def readRewardModel(fileName, mmap=None):
+    """
+    Returns the arrays (dict from name to array) and metadata of the reward model file.
+    With mmap the arrays are read-only memory maps of the file, otherwise they are read into memory.
+    By default the arrays are memory mapped, except on Windows where a memory mapped file cannot be replaced.
+    Raises a ValueError if the file is not a reward model file of a supported format version.
+    """
+    if mmap is None:
+        mmap = os.name != "nt"
+
+    with open(fileName, "rb") as f:
+        header, dataStart = readHeader(f, fileName)
+
+        arrays = dict()
+        for name, entry in header["arrays"].items():
+            dtype, shape = np.dtype(entry["dtype"]), tuple(entry["shape"])
+            if mmap and int(np.prod(shape)) > 0:
+                arrays[name] = np.memmap(fileName, dtype=dtype, mode="r", offset=dataStart + entry["offset"],
+                                         shape=shape)
+            else:
+                f.seek(dataStart + entry["offset"])
+                arrays[name] = np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+    return arrays, header["metadata"]
+
+
+def readHeader(f, fileName=""):
+    """
+    Reads the header of the reward model file opened as f, returns the header and the start of the data section
+    """
+    prefix = f.read(_prefix.size)
+    if len(prefix) != _prefix.size:
+        raise ValueError(fileName + " is not a reward model file")
+    magic, version, headerLength = _prefix.unpack(prefix)
+    if magic != MAGIC:
+        raise ValueError(fileName + " is not a reward model file")
+    if version != FORMAT_VERSION:
+        raise ValueError("Reward model " + fileName + " has format version " + str(version)
+                         + ", expected " + str(FORMAT_VERSION))
+    header = json.loads(f.read(headerLength).decode("utf-8"))
+    return header, -(-(_prefix.size + headerLength) // ALIGNMENT) * ALIGNMENT
+
+
+def readModelVersion(fileName):
+    """
+    Returns the model version of the reward model file, or 0 if the file does not exist or cannot be read
+    """
+    try:
+        with open(fileName, "rb") as f:
+            return int(readHeader(f, fileName)[0]["metadata"].get("modelVersion", 0))
+    except (OSError, ValueError, KeyError):
+        return 0
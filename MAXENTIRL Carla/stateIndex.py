@@ -0,0 +1,96 @@
+"""
+Hash-indexed lookup of state numbers by their features.
+
+The state table maps every state number to its features `lightIsRed` and
+`distanceToGoal`. Finding a state by scanning the table with a boolean mask is
+linear in the number of states; the index in this module quantizes the
+features to integer keys once, so that a single lookup is a dictionary access
+and a batch of lookups is a binary search in a sorted key array.
+"""
+
+import numpy as np
+
+
+def stateKey(features, decimals=3):
+    """
+    Returns the integer key of the features [lightIsRed, distanceToGoal], equal to the keys used by StateIndex
+    """
+    return (int(round(features[0])) << 32) + int(round(features[1] * 10 ** decimals))
+
+
+class StateIndex:
+    """
+    Index from state features `(lightIsRed, distanceToGoal)` to state numbers.
+
+    The distance to the goal is stored rounded to `decimals` decimals by the
+    feature generation, so features are compared after quantizing them to that
+    precision.
+
+    Args:
+        stateTable: The state table as a dataframe with the state numbers as
+            index and the columns `lightIsRed` and `distanceToGoal`.
+        decimals: The number of decimals to which `distanceToGoal` is
+            quantized.
+
+    Attributes:
+        keys: The sorted integer keys of all states.
+        states: The state numbers belonging to `keys`.
+    """
+    def __init__(self, stateTable, decimals=3):
+        self.scale = 10 ** decimals
+
+        keys = self.quantize(stateTable[['lightIsRed', 'distanceToGoal']].to_numpy(dtype=np.float64))
+        states = stateTable.index.to_numpy(dtype=np.int64)
+
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.states = states[order]
+
+        # The first state with a given key is used, like the first match of a table scan
+        self.lookup = dict()
+        for key, state in zip(keys.tolist(), states.tolist()):
+            self.lookup.setdefault(key, state)
+
+    @classmethod
+    def fromArrays(cls, keys, states, decimals=3):
+        """
+        Creates the index from the sorted keys and states of another index, e.g. as stored in a reward model.
+        """
+        index = cls.__new__(cls)
+        index.scale = 10 ** decimals
+        index.keys = np.asarray(keys, dtype=np.int64)
+        index.states = np.asarray(states, dtype=np.int64)
+
+        # The keys are sorted stably, so the first state of every key is the first match of a table scan
+        index.lookup = dict()
+        for key, state in zip(index.keys.tolist(), index.states.tolist()):
+            index.lookup.setdefault(key, state)
+        return index
+
+    def quantize(self, features):
+        """
+        Convert an array of features of shape `(..., 2)` into integer keys.
+        """
+        features = np.asarray(features, dtype=np.float64)
+        lightIsRed = np.rint(features[..., 0]).astype(np.int64)
+        distance = np.rint(features[..., 1] * self.scale).astype(np.int64)
+        return (lightIsRed << 32) + distance
+
+    def findState(self, features):
+        """
+        Returns the state number for the given features `[lightIsRed, distanceToGoal]`,
+        or None if there does not exist a state with these features.
+        """
+        return self.lookup.get(int(self.quantize(features[:2])))
+
+    def findStates(self, features):
+        """
+        Returns the state numbers for an array of features of shape `(n, 2)`.
+        Features without a known state are given the state number -1.
+        """
+        keys = self.quantize(np.asarray(features, dtype=np.float64)[:, :2])
+        positions = np.searchsorted(self.keys, keys, side='left')
+        positions = np.minimum(positions, len(self.keys) - 1)
+
+        found = self.keys[positions] == keys
+        return np.where(found, self.states[positions], -1)
@@ -0,0 +1,137 @@
+"""
+Append-only binary store for the trajectories observed in CARLA.
+
+All steps of all trajectories are stored in a single file `<name>.steps` as
+float64 rows `[lightIsRed, distanceToGoal, performedStop]`, trajectory after
+trajectory. A second file `<name>.offsets` holds the int64 end position of
+every complete trajectory, so the steps of trajectory `i` are the rows
+`offsets[i]` up to `offsets[i+1]` (with `offsets[0] = 0`). Both files are only
+appended to, steps that are not followed by an offset belong to an incomplete
+trajectory and are ignored when reading. The steps of a batch are written
+before its offsets, when a recorder opens the store everything after the last
+complete offset is removed (see `TrajectoryRecorder.recover`).
+
+The steps are stored row-major (one row per step), so a batch of steps is
+appended with a single write and read back with a single reshape.
+"""
+
+import os
+import numpy as np
+
+columnNames = ["lightIsRed", "distanceToGoal", "performedStop"]
+
+
+class TrajectoryRecorder:
+    """
+    Records steps into a preallocated buffer and appends complete trajectories to the store in batches.
+
+    Args:
+        name: The name of the store, the files `<name>.steps` and `<name>.offsets` are created.
+        flushEvery: The number of complete trajectories that are kept in memory before they are written.
+        capacity: The initial number of steps the buffer can hold, the buffer grows when needed.
+    """
+    def __init__(self, name="trajectories", flushEvery=10, capacity=4096):
+        self.stepsFile = name + ".steps"
+        self.offsetsFile = name + ".offsets"
+        self.flushEvery = flushEvery
+
+        self.buffer = np.empty((capacity, len(columnNames)), dtype=np.float64)
+        # Number of steps in the buffer, of which the first completedSteps belong to complete trajectories
+        self.size = 0
+        self.completedSteps = 0
+        # The end positions (in the buffer) of the complete trajectories that are not written yet
+        self.completedEnds = []
+
+        # Position in the store at which the buffer starts
+        self.written = self.recover()
+
+    def recover(self):
+        """
+        Removes everything a previous run did not complete from the store and returns the number of stored steps.
+        The steps of a trajectory are written before its offset, so the store ends with the last complete offset:
+        a partially written offset, offsets past the stored steps and steps after the last offset are removed.
+        """
+        rowSize = len(columnNames) * self.buffer.itemsize
+        storedSteps = os.path.getsize(self.stepsFile) // rowSize if os.path.exists(self.stepsFile) else 0
+        ends = readOffsets(self.offsetsFile)
+        ends = ends[:np.searchsorted(ends, storedSteps, side='right')]
+        written = int(ends[-1]) if len(ends) else 0
+
+        with open(self.offsetsFile, 'ab') as f:
+            f.truncate(ends.nbytes)
+        with open(self.stepsFile, 'ab') as f:
+            f.truncate(written * rowSize)
+        return written
+
+    def addStep(self, features, action):
+        """
+        Add a timestep as features [lightIsRed, distanceToGoal] and performed action to the current trajectory
+        """
+        if self.size == len(self.buffer):
+            self.buffer = np.concatenate((self.buffer, np.empty_like(self.buffer)))
+
+        self.buffer[self.size, :-1] = features[:len(columnNames) - 1]
+        self.buffer[self.size, -1] = action
+        self.size += 1
+
+    def endTrajectory(self, stepsToIgnore=0):
+        """
+        Completes the current trajectory, ignoring its first and last stepsToIgnore steps
+        """
+        begin = self.completedSteps
+        kept = max(self.size - begin - 2 * stepsToIgnore, 0)
+        self.buffer[begin:begin + kept] = self.buffer[begin + stepsToIgnore:begin + stepsToIgnore + kept]
+
+        self.size = self.completedSteps = begin + kept
+        self.completedEnds.append(self.written + self.completedSteps)
+
+        if len(self.completedEnds) >= self.flushEvery:
+            self.flush()
+
+    def flush(self):
+        """
+        Appends all complete trajectories in the buffer to the store
+        """
+        if not self.completedEnds:
+            return
+
+        with open(self.stepsFile, 'ab') as f:
+            self.buffer[:self.completedSteps].tofile(f)
+        with open(self.offsetsFile, 'ab') as f:
+            np.array(self.completedEnds, dtype=np.int64).tofile(f)
+
+        # Keep the steps of the current trajectory at the start of the buffer
+        remaining = self.size - self.completedSteps
+        self.buffer[:remaining] = self.buffer[self.completedSteps:self.size]
+        self.written += self.completedSteps
+        self.size = remaining
+        self.completedSteps = 0
+        self.completedEnds = []
+
+    def close(self):
+        """
+        Writes the remaining complete trajectories, the steps of an unfinished trajectory are dropped
+        """
+        self.flush()
+        self.size = 0
+
+
+def readTrajectoryStore(name="trajectories"):
+    """
+    Returns the steps of all complete trajectories of the store and the offsets index with offsets[0] = 0
+    """
+    ends = readOffsets(name + ".offsets")
+    offsets = np.concatenate(([0], ends)).astype(np.int64)
+
+    steps = np.fromfile(name + ".steps", dtype=np.float64, count=offsets[-1] * len(columnNames))
+    return steps.reshape(-1, len(columnNames)), offsets
+
+
+def readOffsets(offsetsFile):
+    """
+    Returns the end positions of the complete trajectories, a partially written last offset is ignored
+    """
+    if not os.path.exists(offsetsFile):
+        return np.zeros(0, dtype=np.int64)
+    count = os.path.getsize(offsetsFile) // np.dtype(np.int64).itemsize
+    return np.fromfile(offsetsFile, dtype=np.int64, count=count)
@@ -0,0 +1,101 @@
+"""
+Sparse representation of the transition probabilities of an MDP.
+
+Every state-action pair of the CARLA environment only has one or two
+possible next-states, so storing the full `(n_states, n_actions, n_states)`
+table wastes memory quadratically in the number of states. The model in this
+module stores one `scipy.sparse` CSR matrix of shape `(n_states, n_states)`
+per action instead.
+"""
+
+import numpy as np
+import scipy.sparse as sp
+
+
+class SparseTransitionModel:
+    """
+    Transition probabilities stored as one CSR matrix per action.
+
+    The model mimics the parts of the dense `[from, action, to]` table that
+    are used throughout this project: its `shape` and scalar indexing via
+    `model[s, a, s_prime]`.
+
+    Args:
+        matrices: A list of `n_actions` sparse matrices of shape
+            `(n_states, n_states)`, where `matrices[a][s, s_prime]` is the
+            probability of transitioning from `s` to `s_prime` via action `a`.
+
+    Attributes:
+        matrices: The transition matrices per action as CSR matrices.
+    """
+    def __init__(self, matrices):
+        self.matrices = [sp.csr_matrix(m, dtype=np.float64) for m in matrices]
+
+    @classmethod
+    def from_entries(cls, n_states, n_actions, states, actions, next_states, probabilities):
+        """
+        Create a transition model from a list of `(s, a, s', p)` entries.
+
+        Args:
+            n_states: The number of states.
+            n_actions: The number of actions.
+            states: The from-states of all entries.
+            actions: The actions of all entries.
+            next_states: The to-states of all entries.
+            probabilities: The transition probabilities of all entries.
+
+        Returns:
+            The `SparseTransitionModel` holding the given entries.
+        """
+        states = np.asarray(states, dtype=np.int64)
+        actions = np.asarray(actions, dtype=np.int64)
+        next_states = np.asarray(next_states, dtype=np.int64)
+        probabilities = np.asarray(probabilities, dtype=np.float64)
+
+        matrices = []
+        for a in range(n_actions):
+            mask = actions == a
+            matrices.append(sp.csr_matrix(
+                (probabilities[mask], (states[mask], next_states[mask])),
+                shape=(n_states, n_states)))
+        return cls(matrices)
+
+    @classmethod
+    def from_dense(cls, p_transition):
+        """
+        Create a transition model from a dense `[from, action, to]` table.
+
+        Args:
+            p_transition: The dense transition table of shape
+                `(n_states, n_actions, n_states)`.
+
+        Returns:
+            The equivalent `SparseTransitionModel`.
+        """
+        return cls([p_transition[:, a, :] for a in range(p_transition.shape[1])])
+
+    @property
+    def shape(self):
+        """
+        The shape of the equivalent dense table as
+        `(n_states, n_actions, n_states)`.
+        """
+        n_states = self.matrices[0].shape[0]
+        return n_states, len(self.matrices), n_states
+
+    @property
+    def nnz(self):
+        """
+        The number of stored (non-zero) transitions over all actions.
+        """
+        return sum(m.nnz for m in self.matrices)
+
+    def toarray(self):
+        """
+        Convert this model into the dense `[from, action, to]` table.
+        """
+        return np.stack([m.toarray() for m in self.matrices], axis=1)
+
+    def __getitem__(self, key):
+        s, a, s_prime = key
+        return self.matrices[int(a)][int(s), int(s_prime)]
@@ -0,0 +1,277 @@
+"""
+Compact table of the possible transitions of every state-action pair.
+
+The transitions observed in CARLA are saved in `stateTransitions.csv` with
+one row per state-action pair, e.g. `12-0,"{13, 14}"`. The table in this
+module parses this file in bulk into integer arrays holding one
+`(state, action, next_state)` entry per possible transition, grouped per
+state-action pair like the rows of a CSR matrix. The parsed arrays are cached
+in a binary `.npz` file next to the csv file.
+
+Transitions that are not equally likely are declared in an override csv file
+(`transitionOverrides.csv`) with the columns `state`, `action`, `nextState`
+and `probability`. The overrides of a state-action pair replace all of its
+possible transitions.
+
+When the number of times every transition has been observed is recorded
+(`stateTransitionCounts.csv` with the columns `state`, `action`, `nextState`
+and `count`), the probabilities are estimated from these counts instead of
+assuming all next-states to be equally likely. The counts take precedence
+over the overrides: a state-action pair is only overridden if it has not been
+observed, unless the overrides are explicitly allowed to replace the counts.
+"""
+
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+
+class TransitionTable:
+    """
+    The possible next-states of every observed state-action pair.
+
+    Args:
+        states: The from-states of all possible transitions.
+        actions: The actions of all possible transitions.
+        nextStates: The to-states of all possible transitions.
+
+    Attributes:
+        states, actions, nextStates: The entries sorted by state-action pair,
+            the entries of one pair are stored consecutively.
+        pairs: The observed `(state, action)` pairs as array of shape `(n, 2)`.
+        offsets: The entries of `pairs[i]` are stored at positions
+            `offsets[i]` up to `offsets[i+1]`.
+    """
+    def __init__(self, states, actions, nextStates):
+        states = np.asarray(states, dtype=np.int64)
+        actions = np.asarray(actions, dtype=np.int64)
+        nextStates = np.asarray(nextStates, dtype=np.int64)
+
+        entries = np.unique(np.column_stack((states, actions, nextStates)).reshape(-1, 3), axis=0)
+        self.states, self.actions, self.nextStates = entries[:, 0], entries[:, 1], entries[:, 2]
+
+        self.pairs, begin = np.unique(entries[:, :2], axis=0, return_index=True)
+        self.offsets = np.append(begin, len(entries))
+
+        # Maps (state, action) to its position in pairs
+        self.lookup = {(s, a): i for i, (s, a) in enumerate(self.pairs.tolist())}
+
+    @classmethod
+    def fromCsv(cls, csvFile="stateTransitions.csv"):
+        """
+        Parses a csv file with the columns 'state-action' ("s-a") and 'transitions' ("{s1, s2}")
+        """
+        transitionDf = pd.read_csv(csvFile, dtype=str)
+
+        pair = transitionDf['state-action'].str.split('-', expand=True)
+        outcomes = transitionDf['transitions'].str.strip('{} ').str.split(',')
+        n_outcomes = outcomes.str.len().to_numpy()
+
+        nextStates = outcomes.explode().str.strip().to_numpy(dtype=np.int64)
+        states = np.repeat(pair[0].to_numpy(dtype=np.int64), n_outcomes)
+        actions = np.repeat(pair[1].to_numpy(dtype=np.int64), n_outcomes)
+        return cls(states, actions, nextStates)
+
+    @classmethod
+    def load(cls, csvFile="stateTransitions.csv", cache=True):
+        """
+        Loads the transition table of the csv file. The parsed table is stored in a binary file
+        (csvFile with extension .npz), which is used instead of the csv file as long as the csv file is unchanged.
+        """
+        cacheFile = os.path.splitext(csvFile)[0] + ".npz"
+        modified = os.path.getmtime(csvFile)
+
+        if cache and os.path.exists(cacheFile):
+            with np.load(cacheFile) as data:
+                if data["mtime"] == modified:
+                    return cls(data["states"], data["actions"], data["nextStates"])
+
+        table = cls.fromCsv(csvFile)
+        if cache:
+            table.save(cacheFile, mtime=modified)
+        return table
+
+    def save(self, file, mtime=0.0):
+        """
+        Saves the entries of the table as a binary .npz file
+        """
+        np.savez(file, states=self.states, actions=self.actions, nextStates=self.nextStates,
+                 mtime=np.float64(mtime))
+
+    @property
+    def n_actions(self):
+        return int(self.actions.max()) + 1 if len(self.actions) else 0
+
+    def __len__(self):
+        return len(self.states)
+
+    def __contains__(self, pair):
+        return (int(pair[0]), int(pair[1])) in self.lookup
+
+    def outcomes(self, state, action):
+        """
+        Returns the possible next-states of the state-action pair
+        """
+        i = self.lookup[(int(state), int(action))]
+        return self.nextStates[self.offsets[i]:self.offsets[i + 1]]
+
+    def uniformProbabilities(self):
+        """
+        Returns the probability of every entry if all next-states of a state-action pair are equally likely
+        """
+        n_outcomes = np.diff(self.offsets)
+        return np.repeat(1 / n_outcomes, n_outcomes)
+
+    def countProbabilities(self, counts, smoothing=0.0):
+        """
+        Returns the maximum likelihood estimate of the probability of every entry given the observed counts.
+        With smoothing > 0 a symmetric Dirichlet prior over the possible next-states of every pair is used,
+        i.e. smoothing is added to the count of every possible transition.
+        State-action pairs without any observations are given equally likely next-states.
+
+        counts: (states, actions, nextStates, counts) of the observed transitions as returned by readCounts.
+        """
+        cStates, cActions, cNextStates, cCounts = counts
+
+        # Find the count of every entry, transitions that were never observed have count 0
+        n_actions = max(self.n_actions, int(cActions.max()) + 1 if len(cActions) else 0)
+        n_states = max(int(self.states.max()), int(self.nextStates.max()),
+                       int(cStates.max()) if len(cStates) else 0, int(cNextStates.max()) if len(cNextStates) else 0) + 1
+        keys = (self.states * n_actions + self.actions) * n_states + self.nextStates
+        cKeys = (cStates * n_actions + cActions) * n_states + cNextStates
+        order = np.argsort(cKeys)
+        positions = np.minimum(np.searchsorted(cKeys[order], keys), len(cKeys) - 1)
+        found = cKeys[order][positions] == keys
+        entryCounts = np.where(found, cCounts[order][positions], 0.0) + smoothing
+
+        # Use the uniform probabilities for the pairs without observations
+        _, inverse, sums = rowSums(self.states, self.actions, entryCounts)
+        observed = sums[inverse] > 0
+        return np.where(observed, entryCounts / np.where(observed, sums[inverse], 1.0), self.uniformProbabilities())
+
+    def probabilities(self, overrides=None, counts=None, smoothing=0.0, overrideObserved=False):
+        """
+        Returns the entries (states, actions, nextStates, probabilities) of the transition model.
+        All next-states of a state-action pair are equally likely, unless the pair is overridden.
+
+        overrides:          (states, actions, nextStates, probabilities) of the overridden transitions as returned
+                            by readOverrides. The overrides of a state-action pair replace all its transitions,
+                            the probabilities of every overridden pair are normalized to sum to 1.
+        counts:             (states, actions, nextStates, counts) of the observed transitions as returned by
+                            readCounts. If provided the probabilities are estimated from the counts, see
+                            countProbabilities.
+        smoothing:          Dirichlet smoothing added to every count.
+        overrideObserved:   If False the overrides of state-action pairs with observed counts are ignored with a
+                            warning, so the estimates of the counts are used. If True the overrides replace the
+                            estimates of the counts.
+        """
+        states, actions, nextStates = self.states, self.actions, self.nextStates
+        hasCounts = counts is not None and len(counts[0])
+        if hasCounts:
+            probabilities = self.countProbabilities(counts, smoothing)
+        else:
+            probabilities = self.uniformProbabilities()
+
+        if overrides is not None and len(overrides[0]):
+            oStates, oActions, oNextStates, oProbabilities = overrides
+            if (oProbabilities < 0).any():
+                raise ValueError("Transition overrides contain negative probabilities")
+
+            n_actions = max(self.n_actions, int(oActions.max()) + 1,
+                            int(counts[1].max()) + 1 if hasCounts else 0)
+
+            # Ignore the overrides of the state-action pairs that have been observed
+            if hasCounts and not overrideObserved:
+                cStates, cActions, _, cCounts = counts
+                observed = cStates[cCounts > 0] * n_actions + cActions[cCounts > 0]
+                conflict = np.isin(oStates * n_actions + oActions, observed)
+                if conflict.any():
+                    warnings.warn("Ignoring the transition overrides of the observed state-action pairs "
+                                  + str(np.unique(np.column_stack((oStates[conflict], oActions[conflict])),
+                                                  axis=0).tolist()))
+                    oStates, oActions = oStates[~conflict], oActions[~conflict]
+                    oNextStates, oProbabilities = oNextStates[~conflict], oProbabilities[~conflict]
+
+            if len(oStates):
+                # Remove all transitions of the overridden state-action pairs
+                keep = ~np.isin(states * n_actions + actions, oStates * n_actions + oActions)
+
+                oProbabilities = normalizeRows(oStates, oActions, oProbabilities)
+                states = np.concatenate((states[keep], oStates))
+                actions = np.concatenate((actions[keep], oActions))
+                nextStates = np.concatenate((nextStates[keep], oNextStates))
+                probabilities = np.concatenate((probabilities[keep], oProbabilities))
+
+        validateRows(states, actions, probabilities)
+        return states, actions, nextStates, probabilities
+
+    def items(self):
+        """
+        Iterates over ((state, action), nextStates) for all state-action pairs
+        """
+        for i, (s, a) in enumerate(self.pairs.tolist()):
+            yield (s, a), self.nextStates[self.offsets[i]:self.offsets[i + 1]]
+
+
+def readOverrides(csvFile="transitionOverrides.csv"):
+    """
+    Reads the transition overrides as (states, actions, nextStates, probabilities).
+    Lines starting with '#' are ignored. Returns None if the file does not exist.
+    """
+    if not os.path.exists(csvFile):
+        return None
+
+    df = pd.read_csv(csvFile, comment='#', skipinitialspace=True)
+    return (df['state'].to_numpy(dtype=np.int64), df['action'].to_numpy(dtype=np.int64),
+            df['nextState'].to_numpy(dtype=np.int64), df['probability'].to_numpy(dtype=np.float64))
+
+
+def readCounts(csvFile="stateTransitionCounts.csv"):
+    """
+    Reads the observed transition counts as (states, actions, nextStates, counts).
+    Returns None if the file does not exist.
+
+    The counts are recorded by CarlaFeatures.saveTransition. If the observed next-states can be reached from several
+    current states, every current state is credited an equal share (1 / number of current states) of the
+    observations, so the counts are not necessarily integers and the estimated probabilities assume that all
+    current states are equally likely.
+    """
+    if not os.path.exists(csvFile):
+        return None
+
+    df = pd.read_csv(csvFile)
+    return (df['state'].to_numpy(dtype=np.int64), df['action'].to_numpy(dtype=np.int64),
+            df['nextState'].to_numpy(dtype=np.int64), df['count'].to_numpy(dtype=np.float64))
+
+
+def rowSums(states, actions, probabilities):
+    """
+    Returns the (state, action) pairs of the entries and the sum of their probabilities per pair
+    """
+    pairs, inverse = np.unique(np.column_stack((states, actions)).reshape(-1, 2), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    return pairs, inverse, np.bincount(inverse, weights=probabilities, minlength=len(pairs))
+
+
+def normalizeRows(states, actions, probabilities):
+    """
+    Divides the probabilities of the entries by the sum of the probabilities of their (state, action) pair
+    """
+    pairs, inverse, sums = rowSums(states, actions, probabilities)
+    if (sums <= 0).any():
+        raise ValueError("Transition probabilities of state-action pairs "
+                         + str(pairs[sums <= 0].tolist()) + " sum to 0")
+    return probabilities / sums[inverse]
+
+
+def validateRows(states, actions, probabilities, tolerance=1e-9):
+    """
+    Raises a ValueError if the probabilities of a (state, action) pair do not sum to 1
+    """
+    pairs, _, sums = rowSums(states, actions, probabilities)
+    invalid = np.abs(sums - 1) > tolerance
+    if invalid.any():
+        raise ValueError("Transition probabilities of state-action pairs "
+                         + str(pairs[invalid].tolist()) + " do not sum to 1")
@@ -67,6 +67,9 @@ class BasicAgent(object):
         self._max_brake = 0.5
         self._offset = 0
 
+        # Incremented every time the route of the agent changes
+        self._route_version = 0
+
         # Change parameters according to the dictionary
         opt_dict['target_speed'] = target_speed
         if 'ignore_traffic_lights' in opt_dict:
@@ -89,6 +92,8 @@ class BasicAgent(object):
             self._max_brake = opt_dict['max_brake']
         if 'offset' in opt_dict:
             self._offset = opt_dict['offset']
+        # Directory in which the graph of the global route planner is exported, to skip building it next time
+        self._graph_dir = opt_dict.get('graph_dir')
 
         # Initialize the planners
         self._local_planner = LocalPlanner(self._vehicle, opt_dict=opt_dict, map_inst=self._map)
@@ -97,9 +102,11 @@ class BasicAgent(object):
                 self._global_planner = grp_inst
             else:
                 print("Warning: Ignoring the given map as it is not a 'carla.Map'")
-                self._global_planner = GlobalRoutePlanner(self._map, self._sampling_resolution)
+                self._global_planner = GlobalRoutePlanner(self._map, self._sampling_resolution,
+                                                          graph_dir=self._graph_dir)
         else:
-            self._global_planner = GlobalRoutePlanner(self._map, self._sampling_resolution)
+            self._global_planner = GlobalRoutePlanner(self._map, self._sampling_resolution,
+                                                      graph_dir=self._graph_dir)
 
         # Get the static elements of the scene
         self._lights_list = self._world.get_actors().filter("*traffic_light*")
@@ -141,6 +148,10 @@ class BasicAgent(object):
         """Get method for protected member local planner"""
         return self._global_planner
 
+    def get_route_version(self):
+        """Get method for the number of times the route of the agent has changed"""
+        return self._route_version
+
     def set_destination(self, end_location, start_location=None):
         """
         This method creates a list of waypoints between a starting and ending location,
@@ -163,6 +174,7 @@ class BasicAgent(object):
 
         route_trace = self.trace_route(start_waypoint, end_waypoint)
         self._local_planner.set_global_plan(route_trace, clean_queue=clean_queue)
+        self._route_version += 1
 
     def set_global_plan(self, plan, stop_waypoint_creation=True, clean_queue=True):
         """
@@ -177,6 +189,7 @@ class BasicAgent(object):
             stop_waypoint_creation=stop_waypoint_creation,
             clean_queue=clean_queue
         )
+        self._route_version += 1
 
     def trace_route(self, start_waypoint, end_waypoint):
         """
@@ -11,6 +11,9 @@ This module provides GlobalRoutePlanner implementation.
 """
 
 import math
+import os
+from collections import OrderedDict
+from heapq import heappush, heappop
 import numpy as np
 import networkx as nx
 import matplotlib.pyplot as plt
@@ -19,12 +22,57 @@ import carla
 from agents.navigation.local_planner import RoadOption
 from agents.tools.misc import vector
 
+
+class _StoredWaypoint(object):
+    """
+    Waypoint of an imported graph. It holds the attributes stored in the graph file,
+    all other attributes are taken from the waypoint of the map on the same lane and
+    at the same distance s along the road. At the end of a lane the map has another
+    lane at the same location, so the waypoint is only taken by location if s is not known.
+    """
+
+    def __init__(self, wmap, x, y, z, pitch, yaw, roll, road_id, section_id, lane_id, is_junction, s=None):
+        self._wmap = wmap
+        self._waypoint = None
+        self.transform = carla.Transform(carla.Location(x=x, y=y, z=z),
+                                         carla.Rotation(pitch=pitch, yaw=yaw, roll=roll))
+        self.road_id = road_id
+        self.section_id = section_id
+        self.lane_id = lane_id
+        self.is_junction = is_junction
+        if s is not None:
+            self.s = s
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name in ('_wmap', '_waypoint', 's'):
+            raise AttributeError(name)
+        if self._waypoint is None:
+            if 's' in self.__dict__:
+                self._waypoint = self._wmap.get_waypoint_xodr(self.road_id, self.lane_id, self.s)
+            if self._waypoint is None:
+                self._waypoint = self._wmap.get_waypoint(self.transform.location)
+        return getattr(self._waypoint, name)
+
+
+def graph_file_name(map_name, sampling_resolution, directory='.'):
+    """
+    Returns the file name of the exported graph of the map with the given sampling resolution
+    """
+    map_name = map_name.replace('\\', '/').split('/')[-1]
+    return os.path.join(directory, '{}_{}.npz'.format(map_name, sampling_resolution))
+
+
 class GlobalRoutePlanner(object):
     """
     This class provides a very high level route plan.
     """
 
-    def __init__(self, wmap, sampling_resolution):
+    def __init__(self, wmap, sampling_resolution, route_cache_size=128, graph_dir=None):
+        """
+        :param route_cache_size: maximum number of routes in the route cache
+        :param graph_dir: directory of the exported graphs. If the graph of the map and
+            sampling resolution has been exported it is imported, otherwise it is built and exported.
+        """
         self._sampling_resolution = sampling_resolution
         self._wmap = wmap
         self._topology = None
@@ -35,11 +83,46 @@ class GlobalRoutePlanner(object):
         self._intersection_end_node = -1
         self._previous_decision = RoadOption.VOID
 
-        # Build the graph
-        self._build_topology()
-        self._build_graph()
-        self._find_loose_ends()
-        self._lane_change_link()
+        # CSR representation of self._graph used for path searching, see _build_search_graph
+        self._node_ids = None
+        self._node_index = None
+        self._vertices = None
+        self._indptr = None
+        self._indices = None
+        self._weights = None
+        self._search_lists = None
+
+        # Uniform grid over all sampled waypoints of the lanes, see _build_spatial_index.
+        # Waypoints farther than _index_radius from every sampled waypoint of an edge are found by a scan.
+        self._index_radius = sampling_resolution + 2.0
+        self._index_cells = None
+        self._index_locations = None
+        self._index_edges = None
+        self._edge_locations = None
+
+        # LRU cache of the routes between pairs of edges, with structure
+        # {(start edge, end edge): route, ... }
+        self._route_cache = OrderedDict()
+        self._route_cache_size = route_cache_size
+        self._route_cache_hits = 0
+        self._route_cache_misses = 0
+
+        graph_file = None
+        if graph_dir is not None:
+            graph_file = graph_file_name(wmap.name, sampling_resolution, graph_dir)
+
+        if graph_file is not None and os.path.exists(graph_file):
+            self.import_graph(graph_file)
+        else:
+            # Build the graph
+            self._build_topology()
+            self._build_graph()
+            self._find_loose_ends()
+            self._lane_change_link()
+            self._build_spatial_index()
+            self._build_search_graph()
+            if graph_file is not None:
+                self.export_graph(graph_file)
 
     def trace_route(self, origin, destination):
         """
@@ -47,10 +130,13 @@ class GlobalRoutePlanner(object):
         from origin to destination
         """
         route_trace = []
-        route = self._path_search(origin, destination)
         current_waypoint = self._wmap.get_waypoint(origin)
         destination_waypoint = self._wmap.get_waypoint(destination)
+        route = self._cached_route(self._localize_waypoint(current_waypoint),
+                                   self._localize_waypoint(destination_waypoint))
 
+        # The route between the edges is cached, the trace is trimmed to the origin and destination.
+        # The road options depend on the previous decisions and are taken on every call.
         for i in range(len(route) - 1):
             road_option = self._turn_decision(i, route)
             edge = self._graph.edges[route[i], route[i+1]]
@@ -62,7 +148,7 @@ class GlobalRoutePlanner(object):
                 n1, n2 = self._road_id_to_edge[exit_wp.road_id][exit_wp.section_id][exit_wp.lane_id]
                 next_edge = self._graph.edges[n1, n2]
                 if next_edge['path']:
-                    closest_index = self._find_closest_in_list(current_waypoint, next_edge['path'])
+                    closest_index = self._find_closest_in_edge(current_waypoint, (n1, n2), next_edge['path'])
                     closest_index = min(len(next_edge['path'])-1, closest_index+5)
                     current_waypoint = next_edge['path'][closest_index]
                 else:
@@ -71,18 +157,302 @@ class GlobalRoutePlanner(object):
 
             else:
                 path = path + [edge['entry_waypoint']] + edge['path'] + [edge['exit_waypoint']]
-                closest_index = self._find_closest_in_list(current_waypoint, path)
+                closest_index = self._find_closest_in_edge(current_waypoint, (route[i], route[i+1]), path)
                 for waypoint in path[closest_index:]:
                     current_waypoint = waypoint
                     route_trace.append((current_waypoint, road_option))
                     if len(route)-i <= 2 and waypoint.transform.location.distance(destination) < 2*self._sampling_resolution:
                         break
                     elif len(route)-i <= 2 and current_waypoint.road_id == destination_waypoint.road_id and current_waypoint.section_id == destination_waypoint.section_id and current_waypoint.lane_id == destination_waypoint.lane_id:
-                        destination_index = self._find_closest_in_list(destination_waypoint, path)
+                        destination_index = self._find_closest_in_edge(destination_waypoint, (route[i], route[i+1]), path)
                         if closest_index > destination_index:
                             break
         return route_trace
 
+    def route_cache_info(self):
+        """
+        Returns the number of hits and misses of the route cache and its current size
+        """
+        return {'hits': self._route_cache_hits, 'misses': self._route_cache_misses,
+                'size': len(self._route_cache), 'max_size': self._route_cache_size}
+
+    def clear_route_cache(self):
+        """
+        Removes all cached routes. This must be called whenever the graph changes.
+        """
+        self._route_cache.clear()
+
+    def _cached_route(self, start, end):
+        """
+        Returns the route (list of node ids) from the start edge to the end edge, using the route cache
+        """
+        key = (start, end)
+        if key in self._route_cache:
+            self._route_cache_hits += 1
+            self._route_cache.move_to_end(key)
+            return self._route_cache[key]
+
+        self._route_cache_misses += 1
+        route = self._edge_path_search(start, end)
+
+        self._route_cache[key] = route
+        if len(self._route_cache) > self._route_cache_size:
+            self._route_cache.popitem(last=False)
+        return route
+
+    def export_graph(self, path):
+        """
+        Stores the built graph as plain arrays in a .npz file, together with the map name
+        and sampling resolution. All waypoints are stored as (x, y, z, pitch, yaw, roll) and
+        (road_id, section_id, lane_id, is_junction).
+        """
+        waypoints = []
+        waypoint_rows = dict()
+
+        def row(waypoint):
+            if waypoint is None:
+                return -1
+            if id(waypoint) not in waypoint_rows:
+                waypoint_rows[id(waypoint)] = len(waypoints)
+                waypoints.append(waypoint)
+            return waypoint_rows[id(waypoint)]
+
+        node_ids = np.array(list(self._graph.nodes), dtype=np.int64)
+        node_vertices = np.array([self._graph.nodes[n]['vertex'] for n in node_ids], dtype=np.float64).reshape(-1, 3)
+
+        edges = list(self._graph.edges(data=True))
+        edge_nodes = np.array([[n1, n2] for n1, n2, _ in edges], dtype=np.int64).reshape(-1, 2)
+        edge_length = np.array([e['length'] for _, _, e in edges], dtype=np.int64)
+        edge_type = np.array([int(e['type']) for _, _, e in edges], dtype=np.int64)
+        edge_intersection = np.array([bool(e['intersection']) for _, _, e in edges], dtype=bool)
+        edge_waypoints = np.array([[row(e['entry_waypoint']), row(e['exit_waypoint']), row(e.get('change_waypoint'))]
+                                   for _, _, e in edges], dtype=np.int64).reshape(-1, 3)
+        # The entry, exit and net vector of every edge, NaN if the vector is None
+        edge_vectors = np.full((len(edges), 3, 3), np.nan)
+        for i, (_, _, e) in enumerate(edges):
+            for j, name in enumerate(['entry_vector', 'exit_vector', 'net_vector']):
+                if e.get(name) is not None:
+                    edge_vectors[i, j] = e[name]
+        # The waypoints of the path of edge i are path_rows[path_offsets[i]:path_offsets[i+1]]
+        path_rows = np.array([row(w) for _, _, e in edges for w in e['path']], dtype=np.int64)
+        path_offsets = np.concatenate(([0], np.cumsum([len(e['path']) for _, _, e in edges]))).astype(np.int64)
+
+        id_map_vertices = np.array(list(self._id_map.keys()), dtype=np.float64).reshape(-1, 3)
+        id_map_ids = np.array(list(self._id_map.values()), dtype=np.int64)
+        road_edges = np.array([[road_id, section_id, lane_id, n1, n2]
+                               for road_id, sections in self._road_id_to_edge.items()
+                               for section_id, lanes in sections.items()
+                               for lane_id, (n1, n2) in lanes.items()], dtype=np.int64).reshape(-1, 5)
+
+        waypoint_transforms = np.array([[w.transform.location.x, w.transform.location.y, w.transform.location.z,
+                                         w.transform.rotation.pitch, w.transform.rotation.yaw, w.transform.rotation.roll]
+                                        for w in waypoints], dtype=np.float64).reshape(-1, 6)
+        waypoint_lanes = np.array([[w.road_id, w.section_id, w.lane_id, w.is_junction] for w in waypoints],
+                                  dtype=np.int64).reshape(-1, 4)
+        waypoint_s = np.array([w.s for w in waypoints], dtype=np.float64)
+
+        np.savez(path, map_name=np.array(self._wmap.name), sampling_resolution=np.float64(self._sampling_resolution),
+                 node_ids=node_ids, node_vertices=node_vertices,
+                 edge_nodes=edge_nodes, edge_length=edge_length, edge_type=edge_type,
+                 edge_intersection=edge_intersection, edge_waypoints=edge_waypoints, edge_vectors=edge_vectors,
+                 path_rows=path_rows, path_offsets=path_offsets,
+                 id_map_vertices=id_map_vertices, id_map_ids=id_map_ids, road_edges=road_edges,
+                 waypoint_transforms=waypoint_transforms, waypoint_lanes=waypoint_lanes, waypoint_s=waypoint_s)
+
+    def import_graph(self, path):
+        """
+        Loads a graph stored by export_graph, instead of building it from the map.
+        Raises a ValueError if the graph was exported for a different map or sampling resolution.
+        """
+        with np.load(path) as data:
+            data = dict(data)
+
+        map_name = str(data['map_name'])
+        if map_name != self._wmap.name or data['sampling_resolution'] != self._sampling_resolution:
+            raise ValueError("Graph {} was exported for map {} with sampling resolution {}".format(
+                path, map_name, data['sampling_resolution']))
+
+        # Graphs exported before the distance along the road was stored take the map waypoints by location
+        waypoint_s = data['waypoint_s'].tolist() if 'waypoint_s' in data else [None] * len(data['waypoint_lanes'])
+        waypoints = [_StoredWaypoint(self._wmap, *transform, road_id=int(lane[0]), section_id=int(lane[1]),
+                                     lane_id=int(lane[2]), is_junction=bool(lane[3]), s=s)
+                     for transform, lane, s in zip(data['waypoint_transforms'].tolist(),
+                                                   data['waypoint_lanes'].tolist(), waypoint_s)]
+
+        def waypoint(row):
+            return waypoints[row] if row >= 0 else None
+
+        def edge_vector(vector):
+            return None if np.isnan(vector).any() else vector
+
+        self._topology = None
+        self._graph = nx.DiGraph()
+        for node, vertex in zip(data['node_ids'].tolist(), data['node_vertices'].tolist()):
+            self._graph.add_node(node, vertex=tuple(vertex))
+
+        path_offsets = data['path_offsets']
+        for i, (n1, n2) in enumerate(data['edge_nodes'].tolist()):
+            entry_row, exit_row, change_row = data['edge_waypoints'][i].tolist()
+            attributes = dict(
+                length=int(data['edge_length'][i]),
+                path=[waypoints[r] for r in data['path_rows'][path_offsets[i]:path_offsets[i + 1]].tolist()],
+                entry_waypoint=waypoint(entry_row), exit_waypoint=waypoint(exit_row),
+                entry_vector=edge_vector(data['edge_vectors'][i, 0]),
+                exit_vector=edge_vector(data['edge_vectors'][i, 1]),
+                net_vector=edge_vector(data['edge_vectors'][i, 2]),
+                intersection=bool(data['edge_intersection'][i]), type=RoadOption(int(data['edge_type'][i])))
+            if change_row >= 0:
+                attributes['change_waypoint'] = waypoint(change_row)
+            self._graph.add_edge(n1, n2, **attributes)
+
+        self._id_map = {tuple(vertex): node for vertex, node in
+                        zip(data['id_map_vertices'].tolist(), data['id_map_ids'].tolist())}
+        self._road_id_to_edge = dict()
+        for road_id, section_id, lane_id, n1, n2 in data['road_edges'].tolist():
+            self._road_id_to_edge.setdefault(road_id, dict()).setdefault(section_id, dict())[lane_id] = (n1, n2)
+
+        self._build_spatial_index()
+        self._build_search_graph()
+
+    def _build_search_graph(self):
+        """
+        This function builds the compact representation of self._graph used for path searching:
+        the vertex coordinates of all nodes as a numpy array and the successors of every node,
+        with the length of the edge as weight, in CSR format. The successors are stored in
+        the same order as in self._graph. Must be called whenever the graph changes.
+        """
+        self._node_ids = np.array(list(self._graph.nodes), dtype=np.int64)
+        self._node_index = {node: i for i, node in enumerate(self._node_ids.tolist())}
+        self._vertices = np.array([self._graph.nodes[node]['vertex'] for node in self._node_ids.tolist()],
+                                  dtype=np.float64).reshape(-1, 3)
+
+        indptr, indices, weights = [0], [], []
+        for node in self._node_ids.tolist():
+            for neighbor, edge in self._graph.adj[node].items():
+                indices.append(self._node_index[neighbor])
+                weights.append(edge.get('length', 1))
+            indptr.append(len(indices))
+        self._indptr = np.array(indptr, dtype=np.int64)
+        self._indices = np.array(indices, dtype=np.int64)
+        self._weights = np.array(weights, dtype=np.float64)
+        # Python lists are faster to index than numpy arrays in the search loop
+        self._search_lists = (indptr, indices, weights, self._vertices.tolist())
+
+        self.clear_route_cache()
+
+    def _build_spatial_index(self):
+        """
+        This function indexes the sampled waypoints (entry, path and exit waypoints) of all
+        lane follow edges, so that the waypoint of an edge closest to a location is found without
+        computing the distances to all waypoints of the edge:
+        - index_locations: (x,y,z) of every waypoint
+        - index_edges: (n1, n2, index in [entry] + path + [exit]) of every waypoint
+        - index_cells: uniform grid with cells of size index_radius, map from cell to waypoint rows
+        - edge_locations: map from edge to the (x,y,z) of [entry] + path + [exit]
+        """
+        locations, edges = [], []
+        self._edge_locations = dict()
+        for n1, n2, edge in self._graph.edges(data=True):
+            if edge['type'] != RoadOption.LANEFOLLOW:
+                continue
+            waypoints = [edge['entry_waypoint']] + edge['path'] + [edge['exit_waypoint']]
+            edge_locations = [(w.transform.location.x, w.transform.location.y, w.transform.location.z)
+                              for w in waypoints]
+            self._edge_locations[n1, n2] = np.array(edge_locations, dtype=np.float64)
+            locations.extend(edge_locations)
+            edges.extend((n1, n2, i) for i in range(len(waypoints)))
+
+        self._index_locations = np.array(locations, dtype=np.float64).reshape(-1, 3)
+        self._index_edges = np.array(edges, dtype=np.int64).reshape(-1, 3)
+
+        cells = np.floor(self._index_locations[:, :2] / self._index_radius).astype(np.int64)
+        order = np.lexsort((cells[:, 1], cells[:, 0]))
+        unique_cells, begin = np.unique(cells[order], axis=0, return_index=True)
+        self._index_cells = {tuple(cell): rows for cell, rows in
+                             zip(unique_cells.tolist(), np.split(order, begin[1:]))}
+
+    def _nearest_indexed(self, location, edge):
+        """
+        Returns the row of the indexed waypoint of the lane follow edge closest to location,
+        or None if there is no indexed waypoint of the edge within index_radius.
+        """
+        if not self._index_cells:
+            return None
+        cx = int(math.floor(location.x / self._index_radius))
+        cy = int(math.floor(location.y / self._index_radius))
+        candidates = [self._index_cells[cell] for cell in
+                      ((cx + dx, cy + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1))
+                      if cell in self._index_cells]
+        if not candidates:
+            return None
+        rows = np.concatenate(candidates)
+        rows = rows[(self._index_edges[rows, 0] == edge[0]) & (self._index_edges[rows, 1] == edge[1])]
+        if not len(rows):
+            return None
+        point = np.array([location.x, location.y, location.z])
+        distances = np.linalg.norm(self._index_locations[rows] - point, axis=1)
+        closest = np.lexsort((self._index_edges[rows, 2], distances))[0]
+        if distances[closest] > self._index_radius:
+            return None
+        return rows[closest]
+
+    def _astar_search(self, source, target):
+        """
+        A* search with Euclidean distance heuristic on the CSR representation of the graph.
+        It expands the nodes in the same order as networkx.astar_path, and thus returns the same path.
+        source, target  :   node ids of the graph self._graph
+        return          :   path as list of node ids
+        """
+        if source not in self._node_index or target not in self._node_index:
+            raise nx.NodeNotFound("Either source {} or target {} is not in the graph".format(source, target))
+        source, target = self._node_index[source], self._node_index[target]
+
+        indptr, indices, weights, vertices = self._search_lists
+        tx, ty, tz = vertices[target]
+
+        count = 0
+        queue = [(0, count, source, 0, -1)]
+        # Cost of the best path found to every enqueued node and its heuristic
+        enqueued = {}
+        # Parent on the best path to every explored node, -1 for the source
+        explored = {}
+        while queue:
+            _, _, current, dist, parent = heappop(queue)
+            if current == target:
+                path = [current]
+                node = parent
+                while node != -1:
+                    path.append(node)
+                    node = explored[node]
+                path.reverse()
+                return [self._node_ids[i].item() for i in path]
+
+            if current in explored:
+                # Do not override the parent of the source
+                if explored[current] == -1:
+                    continue
+                # Skip paths that were enqueued before a better one was found
+                if enqueued[current][0] < dist:
+                    continue
+            explored[current] = parent
+
+            for k in range(indptr[current], indptr[current + 1]):
+                neighbor = indices[k]
+                cost = dist + weights[k]
+                if neighbor in enqueued:
+                    queued_cost, h = enqueued[neighbor]
+                    if queued_cost <= cost:
+                        continue
+                else:
+                    x, y, z = vertices[neighbor]
+                    h = math.sqrt((x - tx) * (x - tx) + (y - ty) * (y - ty) + (z - tz) * (z - tz))
+                enqueued[neighbor] = cost, h
+                count += 1
+                heappush(queue, (cost + h, count, neighbor, cost, current))
+
+        raise nx.NetworkXNoPath("Node {} not reachable from {}".format(
+            self._node_ids[target], self._node_ids[source]))
+
     def _build_topology(self):
         """
         This function retrieves topology from the server as a list of
@@ -245,7 +615,7 @@ class GlobalRoutePlanner(object):
                                 and next_waypoint.lane_type == carla.LaneType.Driving \
                                 and waypoint.road_id == next_waypoint.road_id:
                             next_road_option = RoadOption.CHANGELANERIGHT
-                            next_segment = self._localize(next_waypoint.transform.location)
+                            next_segment = self._localize_waypoint(next_waypoint)
                             if next_segment is not None:
                                 self._graph.add_edge(
                                     self._id_map[segment['entryxyz']], next_segment[0], entry_waypoint=waypoint,
@@ -258,7 +628,7 @@ class GlobalRoutePlanner(object):
                                 and next_waypoint.lane_type == carla.LaneType.Driving \
                                 and waypoint.road_id == next_waypoint.road_id:
                             next_road_option = RoadOption.CHANGELANELEFT
-                            next_segment = self._localize(next_waypoint.transform.location)
+                            next_segment = self._localize_waypoint(next_waypoint)
                             if next_segment is not None:
                                 self._graph.add_edge(
                                     self._id_map[segment['entryxyz']], next_segment[0], entry_waypoint=waypoint,
@@ -273,7 +643,12 @@ class GlobalRoutePlanner(object):
         This function finds the road segment that a given location
         is part of, returning the edge it belongs to
         """
-        waypoint = self._wmap.get_waypoint(location)
+        return self._localize_waypoint(self._wmap.get_waypoint(location))
+
+    def _localize_waypoint(self, waypoint):
+        """
+        This function returns the edge that the lane of a given waypoint belongs to
+        """
         edge = None
         try:
             edge = self._road_id_to_edge[waypoint.road_id][waypoint.section_id][waypoint.lane_id]
@@ -300,10 +675,16 @@ class GlobalRoutePlanner(object):
         connecting origin and destination
         """
         start, end = self._localize(origin), self._localize(destination)
+        return self._edge_path_search(start, end)
 
-        route = nx.astar_path(
-            self._graph, source=start[0], target=end[0],
-            heuristic=self._distance_heuristic, weight='length')
+    def _edge_path_search(self, start, end):
+        """
+        This function finds the shortest path connecting the start and end edge
+        using A* search with distance heuristic.
+        start, end  :   edges (pairs of node ids) as returned by self._localize
+        return      :   path as list of node ids (as int) of the graph self._graph
+        """
+        route = self._astar_search(start[0], end[0])
         route.append(end[1])
         return route
 
@@ -391,6 +772,30 @@ class GlobalRoutePlanner(object):
         self._previous_decision = decision
         return decision
 
+    def _find_closest_in_edge(self, current_waypoint, edge, waypoint_list):
+        """
+        Returns the index of the waypoint closest to current_waypoint in waypoint_list, which is
+        either [entry] + path + [exit] or the path of the lane follow edge. The waypoint is looked
+        up in the spatial index, only if no waypoint of the edge is near current_waypoint the
+        distances to all indexed locations of the edge are computed.
+        """
+        locations = self._edge_locations.get(edge)
+        if locations is None:
+            return self._find_closest_in_list(current_waypoint, waypoint_list)
+        offset = 0
+        if len(waypoint_list) == len(locations) - 2:
+            locations, offset = locations[1:-1], 1
+        elif len(waypoint_list) != len(locations):
+            return self._find_closest_in_list(current_waypoint, waypoint_list)
+
+        location = current_waypoint.transform.location
+        row = self._nearest_indexed(location, edge)
+        if row is not None and 0 <= self._index_edges[row, 2] - offset < len(locations):
+            return int(self._index_edges[row, 2]) - offset
+
+        distances = np.linalg.norm(locations - (location.x, location.y, location.z), axis=1)
+        return int(np.argmin(distances)) if len(distances) else -1
+
     def _find_closest_in_list(self, current_waypoint, waypoint_list):
         min_distance = float('inf')
         closest_index = -1
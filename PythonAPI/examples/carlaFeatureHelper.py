@@ -1,9 +1,30 @@
+import os
+import sys
 import numpy as np
 import pandas as pd
 import pandas as pd
 from enum import IntEnum
 import math
 
+# ==============================================================================
+# -- Add the MAXENTIRL directory with the shared modules -----------------------
+# ==============================================================================
+# The state index, transition table, trajectory store and reward model file are shared with the MAXENTIRL
+# directory. Set MAXENTIRL_DIR if the examples are placed in the installed carla directory.
+MAXENTIRL_DIR = os.environ.get("MAXENTIRL_DIR", os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "MAXENTIRL Carla"))
+sys.path.append(MAXENTIRL_DIR)
+
+from rewardModel import readRewardModel
+from stateIndex import StateIndex, stateKey
+from transitionTable import TransitionTable, readCounts, readOverrides
+from trajectoryStore import TrajectoryRecorder
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
 
 class RoadOption(IntEnum):
     """
@@ -19,26 +40,99 @@ class RoadOption(IntEnum):
     CHANGELANERIGHT = 6
 
 
+class RouteProfile(object):
+    """
+    The remaining distance to the goal from every waypoint of a planned route.
+
+    The distance to the goal of a location is found from the route waypoint closest to the location, which is found
+    with a KD-tree over the waypoints (or by comparing all waypoints if scipy is not available). The distance to the
+    goal is the remaining distance of this waypoint, so it changes in steps of the sampling resolution as the states
+    of stateFeatures.csv. With project the location is projected on the route segments before and after this
+    waypoint and the distance changes continuously, this requires a state table generated with projection.
+    """
+
+    def __init__(self, route, project=False):
+        self.project = project
+        self.locations = np.array([[wp.transform.location.x, wp.transform.location.y, wp.transform.location.z]
+                                   for wp, _ in route], dtype=np.float64).reshape(-1, 3)
+
+        # remaining[i] is the length of the route from waypoint i up to the last waypoint
+        self.directions = np.diff(self.locations, axis=0)
+        segments = np.linalg.norm(self.directions, axis=1)
+        self.remaining = np.append(np.cumsum(segments[::-1])[::-1], 0.0)
+        self.length = self.remaining[0]
+
+        self.tree = cKDTree(self.locations) if cKDTree is not None and len(self.locations) else None
+
+    def distanceToGoal(self, location):
+        """
+        Returns the length of the route from the waypoint closest to the location (or the projection of the location
+        on the route) up to the goal
+        """
+        point = np.array([location.x, location.y, location.z])
+        if self.tree is not None:
+            _, index = self.tree.query(point)
+        else:
+            index = np.argmin(np.sum((self.locations - point) ** 2, axis=1))
+
+        # Project the location on the segments from the previous to the closest waypoint and from the closest to the
+        # next waypoint, and take the closest projection
+        segments = np.arange(max(index - 1, 0), min(index + 1, len(self.directions)))
+        if not self.project or not len(segments):
+            return self.remaining[index]
+        directions = self.directions[segments]
+        squaredLengths = np.sum(directions ** 2, axis=1)
+        t = np.sum((point - self.locations[segments]) * directions, axis=1) / np.where(squaredLengths > 0,
+                                                                                        squaredLengths, 1.0)
+        t = np.clip(t, 0.0, 1.0)
+        projections = self.locations[segments] + t[:, None] * directions
+        closest = np.argmin(np.sum((projections - point) ** 2, axis=1))
+        segment = segments[closest]
+        return self.remaining[segment + 1] + (1.0 - t[closest]) * np.sqrt(squaredLengths[closest])
+
+
 class CarlaFeatures(object):
-    def __init__(self) -> None:
+    def __init__(self, useRouteProfile=True, projectOnRoute=False) -> None:
+        """
+        useRouteProfile:    Calculate the distance to the goal from a route profile which is only planned once
+                            per destination. If False the route to the goal is planned every timestep.
+        projectOnRoute:     Project the location on the route profile for a continuous distance to the goal instead
+                            of taking the closest route waypoint. This gives different states than stateFeatures.csv,
+                            so the states and transitions must be generated again with the same setting.
+        """
         self.actions = [True, False]
         self.featuresNames = ["lightIsRed", "distanceToGoal", "performedStop"]
 
-        # Parameters needed for saving trajectories
-        self.currentTrajectory = []
+        # Parameters needed for saving trajectories, the recorder is created when the first step is observed
+        self.trajectoryRecorder = None
         self.currentTrajectoryNumber = 0
 
-        # The number of trajectories observed in the demonstration
-        self.maxTrajectories = 30
+        # The number of trajectories observed in the demonstration, None to observe trajectories until stopped
+        self.maxTrajectories = None
         self.initalDistance = None
 
+        # The profile of the route to the destination, planned again when the route of the agent
+        # or the destination changes.
+        self.useRouteProfile = useRouteProfile
+        self.projectOnRoute = projectOnRoute
+        self.routeProfile = None
+        self.routeProfileKey = None
+
         # Parameters used to create transitions
-        self.states = pd.DataFrame(columns=self.featuresNames[:-1])
+        # Maps the key of the features of every known state to its state number,
+        # states are numbered in the order in which they are observed
+        self.stateNumbers = dict()
+        # The features of every known state, stored at the position of its state number
+        self.states = []
         self.transitions = dict()
         # Holds the current states from which we performed the action
         self.curStateSet = set()
         # Holds the states to which we transitioned.
         self.nextStateSet = set()
+        # Maps (state, action) to the (expected) number of times each next state has been observed from the state
+        self.transitionCounts = dict()
+        # Holds the number of times each state has been transitioned to
+        self.nextStateCounts = dict()
 
     def generateFeatures(self, trafficLightMsg, agent, destination, debug=False, initDistance=None):
         """
@@ -53,24 +147,13 @@ class CarlaFeatures(object):
 
         # Calculate percentage traveled for road section
         veh_loc = agent._vehicle.get_location()
-        total = 0
         # Calculate distance to the destination
         if not self.initalDistance:
-            lastwp = None
-            for wp, _ in agent._global_planner.trace_route(initDistance, destination.location):
-                if not lastwp:
-                    lastwp = wp.transform.location                
-                total += lastwp.distance(wp.transform.location)
-                lastwp = wp.transform.location
+            total = self.routeLength(agent, initDistance, destination)
             self.initalDistance = math.ceil(total)
             features[1] = 1.0
         else:
-            lastwp = None
-            for wp, _ in agent._global_planner.trace_route(veh_loc, destination.location):        
-                if not lastwp:
-                    lastwp = wp.transform.location                
-                total += lastwp.distance(wp.transform.location)
-                lastwp = wp.transform.location
+            total = self.routeLength(agent, veh_loc, destination)
             features[1] = round(total / self.initalDistance, 3)
 
         if debug:
@@ -78,28 +161,56 @@ class CarlaFeatures(object):
 
         return features
 
+    def routeLength(self, agent, location, destination):
+        """
+        Returns the length of the route from the location to the destination
+        """
+        if not self.useRouteProfile:
+            total = 0
+            lastwp = None
+            for wp, _ in agent._global_planner.trace_route(location, destination.location):
+                if not lastwp:
+                    lastwp = wp.transform.location
+                total += lastwp.distance(wp.transform.location)
+                lastwp = wp.transform.location
+            return total
+
+        key = (agent.get_route_version(), destination.location.x, destination.location.y, destination.location.z)
+        if self.routeProfile is None or key != self.routeProfileKey:
+            # Plan the route from the current location once, later locations are projected on this route
+            self.routeProfile = RouteProfile(agent._global_planner.trace_route(location, destination.location),
+                                             self.projectOnRoute)
+            self.routeProfileKey = key
+        return self.routeProfile.distanceToGoal(location)
+
     def addStep(self, features, actionToPerform):
         """
         Add a timestep as features and performed action to the current (observing) trajectory
         """
-        self.currentTrajectory.append((features, actionToPerform))
+        if self.trajectoryRecorder is None:
+            self.trajectoryRecorder = TrajectoryRecorder("trajectories")
+        self.trajectoryRecorder.addStep(features, actionToPerform)
 
     def saveTrajectory(self, stepsToIgnore=3):
         """
-        Saves the current trajectory as a csv file.
+        Saves the current trajectory to the trajectory store (trajectories.steps and trajectories.offsets).
+        Returns True once maxTrajectories trajectories have been saved.
 
         stepsToIgnore:  Part of the trajectory which will not be saved.
                         By default the first and last 3 observations will be ignored.
         """
-        df = pd.DataFrame(columns=self.featuresNames)
-        for step in self.currentTrajectory[stepsToIgnore:-stepsToIgnore]:
-            step[0].append(step[1])
-            df.loc[len(df)] = pd.Series(step[0], index=self.featuresNames)
-        df.to_csv('traj'+str(self.currentTrajectoryNumber)+'.csv', index=False)
+        if self.trajectoryRecorder is None:
+            self.trajectoryRecorder = TrajectoryRecorder("trajectories")
+        self.trajectoryRecorder.endTrajectory(stepsToIgnore)
         self.currentTrajectoryNumber += 1
-        self.currentTrajectory = []
-        if self.currentTrajectoryNumber == self.maxTrajectories:
-            exit()
+        return self.maxTrajectories is not None and self.currentTrajectoryNumber >= self.maxTrajectories
+
+    def closeTrajectories(self):
+        """
+        Writes all saved trajectories that are still buffered to the trajectory store
+        """
+        if self.trajectoryRecorder is not None:
+            self.trajectoryRecorder.close()
 
     def addTransition(self, features):
         """
@@ -112,23 +223,27 @@ class CarlaFeatures(object):
 
         # Add state to the set of possible transition states.
         self.nextStateSet.add(stateId[0])
+        self.nextStateCounts[stateId[0]] = self.nextStateCounts.get(stateId[0], 0) + 1
 
     def addState(self, features):
         """
-        Add state to states dataframe. State is already in df then the state number will be returned
+        Add state to the known states. State is already known then the state number will be returned
         """
         stateId = self.getStateNumber(features)
         if not stateId:
             # No state is known with the features.
             index = len(self.states)
-            self.states.loc[index] = pd.Series(
-                features, index=self.featuresNames[:-1])
+            self.stateNumbers[stateKey(features)] = index
+            self.states.append(list(features[:len(self.featuresNames) - 1]))
             return [index]
         else:
             return stateId
 
     def saveTransition(self, action):
         # Save the observed transition.
+        # The observed next states are reached from one of the current states, which one is not known,
+        # so every current state is credited an equal share of the observations
+        share = 1.0 / len(self.curStateSet) if self.curStateSet else 0.0
         for i in list(self.curStateSet):
             if str(i)+"-"+str(action) in self.transitions:
                 self.transitions[str(
@@ -136,6 +251,9 @@ class CarlaFeatures(object):
             else:
                 self.transitions[str(
                     i)+"-"+str(action)] = set(self.nextStateSet)
+            counts = self.transitionCounts.setdefault((i, action), dict())
+            for state, count in self.nextStateCounts.items():
+                counts[state] = counts.get(state, 0) + count * share
 
         # During the creation of the transition function first the brake actions are performed,
         # afterwards the no-brake actions are performed. In order to obtain the correct transition
@@ -144,23 +262,26 @@ class CarlaFeatures(object):
         if not action:
             self.curStateSet = set(self.nextStateSet)
         self.nextStateSet.clear()
+        self.nextStateCounts.clear()
 
     def getStateNumber(self, features):
         """
         Returns the state number for the given state features.
         Will return an empty list if there does not exists a state with the features.
         """
-        return self.states[(self.states[self.featuresNames[0]] == features[0])
-                           & (self.states[self.featuresNames[1]] == features[1])].index.tolist()
+        stateId = self.stateNumbers.get(stateKey(features))
+        return [] if stateId is None else [stateId]
 
     def getStateFeatures(self, stateNumber):
-        features = self.states.loc[stateNumber, :].values.flatten().tolist()
+        features = list(self.states[stateNumber])
         return features
 
     def saveStateAndTransitions(self):
         # Saves the transitions and states observed (including the state-features)
-        self.states.to_csv("stateFeatures.csv", index=True)
-        print(self.states)
+        states = pd.DataFrame(self.states, columns=self.featuresNames[:-1])
+        states.to_csv("stateFeatures.csv", index=True)
+        np.save("stateFeatures.npy", states.to_numpy(dtype=np.float64))
+        print(states)
         print("\n\n\n")
         df = pd.DataFrame([list(self.transitions.keys()), list(
             self.transitions.values())]).transpose()
@@ -168,13 +289,47 @@ class CarlaFeatures(object):
         df.to_csv('stateTransitions.csv', index=False)
         print(df)
 
+        # The number of times each transition has been observed, used to estimate the transition probabilities
+        counts = [[state, action, nextState, count] for (state, action), nextStates in self.transitionCounts.items()
+                  for nextState, count in nextStates.items()]
+        pd.DataFrame(counts, columns=['state', 'action', 'nextState', 'count']).to_csv(
+            'stateTransitionCounts.csv', index=False)
+
+
+def defaultOverrideFile():
+    """
+    Returns transitionOverrides.csv of the working directory if it exists, otherwise the one of the MAXENTIRL directory
+    """
+    if os.path.exists("transitionOverrides.csv"):
+        return "transitionOverrides.csv"
+    return os.path.join(MAXENTIRL_DIR, "transitionOverrides.csv")
+
 
 class IRLReward(object):
 
-    def __init__(self, featureweights):
+    def __init__(self, featureweights=None, modelFile=None, mmap=None):
+        """
+        featureweights: The learned feature weights of the reward function.
+        modelFile:      Reward model file written by carlaMaxIRL (see rewardModel.py). If provided the weights,
+                        states, transitions and the policy compiled by soft value iteration are all loaded from this
+                        file instead of the csv files, and a new version of the file is loaded by reloadRewardModel.
+                        The actions are then taken from the policy.
+        mmap:           Memory map the arrays of the reward model file instead of reading them. By default the arrays
+                        are memory mapped, except on Windows where carlaMaxIRL cannot replace a memory mapped file.
+        """
+        self.modelFile = modelFile
+        self.mmap = mmap
+        self.modelVersion = None
+        self.modelModified = None
+        if modelFile is not None:
+            self.loadRewardModel(modelFile)
+            return
+
         self.featureweights = np.array(featureweights)
 
         self.stateTable = self.loadStates()
+        # Index used to find the state number for given state features
+        self.stateIndex = StateIndex(self.stateTable)
 
         # The transition table for every state-action pair
         self.transitionTable = self.generateTransitionTable()
@@ -182,90 +337,48 @@ class IRLReward(object):
         # The probability of transitioning to state s for every state-action pair
         self.p_transition = self.generateProbTransition()
 
+        # The expected reward of every state-action pair and the action with the highest expected reward per state
+        self.qTable = self.generateQTable()
+        self.bestActions = np.argmax(self.qTable, axis=1)
+
+        # The action probabilities and most likely action of every state of the compiled policy, only available
+        # in the reward model file
+        self.actionProbabilities = None
+        self.policyActions = None
+
     def loadStates(self):
         df = pd.read_csv("stateFeatures.csv", index_col=0)
         return df
 
     def generateTransitionTable(self):
         """"
-        Function which generates a dictonary with the transitions for each state-action pair
+        Function which loads the possible transitions for each state-action pair
         """
-        transitionDf = pd.read_csv("stateTransitions.csv")
-
-        stateActionTransitions = dict()
-        for _, row in transitionDf.iterrows():
-            stateActionTransitions[row['state-action']
-                                   ] = set(eval(row['transitions']))
-        return stateActionTransitions
+        return TransitionTable.load("stateTransitions.csv")
 
-    def generateProbTransition(self, debug=False,scenario = 0):
+    def generateProbTransition(self, debug=False, overrideFile=None,
+                               countFile="stateTransitionCounts.csv", smoothing=0.0, overrideObserved=False):
         """
         Function used to create the transition probabilities for every (s,a,s')
+
+        overrideFile:   csv file with the custom probabilities [s,a,s',p] of the non deterministic states.
+                        By default transitionOverrides.csv of the working directory, if a scenario provides its
+                        own file (e.g. in Scenario2StatesAndTransition), or else the one of the MAXENTIRL directory.
+        countFile:      csv file with the number of times every (s,a,s') has been observed. If it exists the
+                        probabilities are estimated from these counts instead of being equally likely.
+        smoothing:      Dirichlet smoothing added to every count of a possible transition.
+        overrideObserved: If True the custom probabilities also replace the estimates of state-action pairs
+                        with observed counts, otherwise only the unobserved pairs are overridden.
         """
         n_states = self.stateTable.shape[0]
-
-        stateActions = list(self.transitionTable.keys())
-        possibleActions = set()
-        for stateAction in stateActions:
-            possibleActions.add(int(stateAction.split("-")[1]))
-
-        n_actions = len(possibleActions)
+        n_actions = self.transitionTable.n_actions
         pTable = np.zeros(shape=(n_states, n_actions, n_states))
 
-        # Set the transition probability for each state-action pair to equally likely for all the possible next-states
-        for stateAction, outcomeStates in self.transitionTable.items():
-            pair = stateAction.split("-")
-            outcomes = set(outcomeStates)
-            n_outcomes = len(outcomes)
-            while outcomes:
-                state = outcomes.pop()
-                pTable[int(pair[0]), int(pair[1]), state] = 1/n_outcomes
-
-        if scenario == 0:
-            # list of custom probabilities holding [s,a,s',p] for scenario 0
-            customProbabilities = [[24, 1, 24, 0.99], [24, 1, 25, 0.01],
-                                [24, 0, 26, 0.99], [24, 0, 27, 0.01],
-
-                                [25, 1, 25, 0.99], [25, 1, 24, 0.01],
-                                [25, 0, 27, 0.99], [25, 0, 26, 0.01],
-
-                                [26, 1, 26, 0.99], [26, 1, 27, 0.01],
-                                [26, 0, 28, 0.99], [26, 0, 29, 0.01],
-                                
-                                [27, 1, 27, 0.99], [27, 1, 26, 0.01],
-                                [27, 0, 29, 0.99], [27, 0, 28, 0.01],
-
-                                [28, 1, 28, 0.99], [28, 1, 29, 0.01],
-                                [29, 1, 29, 0.99], [29, 1, 28, 0.01],
-                                ]
-            
-            
-            for probabilty in customProbabilities:
-                pTable[probabilty[0], probabilty[1], probabilty[2]] = probabilty[3]
-        
-        elif scenario == 1:
-            # list of custom probabilities holding [s,a,s',p] for scenario 1
-            customProbabilities = [[40, 1, 40, 0.99], [40, 1, 41, 0.01],
-                                [40, 0, 42, 0.99], [40, 0, 43, 0.01],
-
-                                [41, 1, 41, 0.99], [41, 1, 40, 0.01],
-                                [41, 0, 43, 0.99], [41, 0, 42, 0.01],
-
-                                [44, 1, 44, 0.99], [44, 1, 45, 0.01],
-                                [45, 1, 45, 0.99], [45, 1, 44, 0.01],
-                                
-                                [42, 1, 42, 0.99], [42, 1, 43, 0.01],
-                                [42, 0, 44, 0.99], [42, 0, 45, 0.01],
-
-                                [43, 1, 43, 0.99], [43, 1, 42, 0.01],
-                                [43, 0, 45, 0.99], [43, 0, 44, 0.01],
-                                ]
-            
-            
-            for probabilty in customProbabilities:
-                pTable[probabilty[0], probabilty[1], probabilty[2]] = probabilty[3]
-
-
+        # The possible next-states of each state-action pair are equally likely or estimated from the counts,
+        # unless overridden
+        states, actions, nextStates, values = self.transitionTable.probabilities(
+            readOverrides(overrideFile or defaultOverrideFile()), readCounts(countFile), smoothing, overrideObserved)
+        pTable[states, actions, nextStates] = values
 
         if debug:
             for s in range(pTable.shape[0]):
@@ -281,46 +394,153 @@ class IRLReward(object):
 
         return pTable
 
+    def generateQTable(self):
+        """
+        Returns the expected reward sum_s' p(s'|s,a) * r(s') of every state-action pair as array of shape
+        (n_states, n_actions), with r(s') = features(s') . featureweights.
+        State-action pairs without possible transitions are given -inf.
+        """
+        stateRewards = self.stateTable.to_numpy(dtype=np.float64) @ self.featureweights
+        qTable = self.p_transition @ stateRewards
+        qTable[self.p_transition.sum(axis=2) == 0] = -np.inf
+        return qTable
+
+    def loadRewardModel(self, modelFile):
+        """
+        Loads the reward model file written by carlaMaxIRL, replacing the current reward model
+        """
+        modified = os.stat(modelFile).st_mtime_ns
+        arrays, metadata = readRewardModel(modelFile, self.mmap)
+
+        n_states, n_actions = metadata["nStates"], metadata["nActions"]
+        stateTable = pd.DataFrame(np.asarray(arrays["stateFeatures"]), columns=metadata["featureNames"])
+        stateIndex = StateIndex.fromArrays(arrays["stateKeys"], arrays["stateNumbers"], metadata["decimals"])
+
+        states, actions = arrays["transitionStates"], arrays["transitionActions"]
+        nextStates = arrays["transitionNextStates"]
+        pTable = np.zeros(shape=(n_states, n_actions, n_states))
+        pTable[states, actions, nextStates] = arrays["transitionProbabilities"]
+
+        # Replace the model only after the new model has been read completely
+        self.featureweights = np.array(arrays["featureweights"])
+        self.stateTable = stateTable
+        self.stateIndex = stateIndex
+        self.transitionTable = TransitionTable(states, actions, nextStates)
+        self.p_transition = pTable
+        self.qTable = arrays["qTable"]
+        self.bestActions = arrays["bestActions"]
+        self.actionProbabilities = arrays["actionProbabilities"]
+        self.policyActions = arrays["policyActions"]
+        self.modelFile = modelFile
+        self.modelVersion = metadata["modelVersion"]
+        self.modelModified = modified
+
+    def reloadRewardModel(self):
+        """
+        Loads the reward model file again if it has been changed since it was loaded.
+        Returns True if a new reward model is loaded. If the new file cannot be read the current model is kept.
+        """
+        if self.modelFile is None:
+            return False
+        try:
+            modified = os.stat(self.modelFile).st_mtime_ns
+        except OSError:
+            return False
+        if modified == self.modelModified:
+            return False
+
+        try:
+            self.loadRewardModel(self.modelFile)
+        except (OSError, ValueError, KeyError) as e:
+            print("Reward model", self.modelFile, "could not be loaded:", e)
+            self.modelModified = modified
+            return False
+        return True
+
+    def bestAction(self, features, possibleActions=None):
+        """
+        Returns the most likely action out of possibleActions (by default all actions) of the compiled policy in the
+        state with the given features, or the action with the highest expected reward if no policy is loaded or the
+        policy has none of the actions in this state. Returns None if the state is unknown or none of the actions
+        has any transition, i.e. the expected reward of every action is -inf.
+        """
+        currentState = self.findStateInStateTable(features)
+        if currentState is None:
+            return None
+        if possibleActions is None:
+            if self.policyActions is not None and self.policyActions[currentState] >= 0:
+                return int(self.policyActions[currentState])
+            if not np.any(np.isfinite(self.qTable[currentState])):
+                return None
+            return int(self.bestActions[currentState])
+
+        actions = np.asarray(possibleActions, dtype=np.int64)
+        if self.actionProbabilities is not None:
+            probabilities = self.actionProbabilities[currentState, actions]
+            if np.any(probabilities > 0):
+                return int(actions[np.argmax(probabilities)])
+        values = self.qTable[currentState, actions]
+        if not np.any(np.isfinite(values)):
+            return None
+        return int(actions[np.argmax(values)])
+
     def calculateStateActionValue(self, features, actionToPerform, debug=True):
         currentState = self.findStateInStateTable(features)
-        if not currentState:
+        if currentState is None:
             print("state not found based on features", features)
             exit()
 
-        nextStates = set(self.transitionTable[str(
-            currentState)+"-" + str(actionToPerform)])
-        reward = 0
-        while nextStates:
-            state = nextStates.pop()
-            p = self.p_transition[int(currentState),
-                                  int(actionToPerform), state]
-            reward += p * np.dot(self.findStateFeatures(state).to_numpy()
-                           ,self.featureweights.T)
-            
+        reward = self.qTable[currentState, int(actionToPerform)]
+
         if debug:
             print("Action", actionToPerform, "results in an estimated reward of", reward)
 
         return reward
 
     def findStateInStateTable(self, state):
-        return self.stateTable.loc[(self.stateTable['lightIsRed'] == (state[0])) & (self.stateTable['distanceToGoal'] == (state[1]))].index[0]
+        """
+        Returns the state number for the given state features, or None if the state is unknown
+        """
+        return self.stateIndex.findState(state)
+
+    def findStatesInStateTable(self, states):
+        """
+        Returns the state numbers for an array of state features, unknown states are given -1
+        """
+        return self.stateIndex.findStates(states)
 
     def findStateFeatures(self, stateNumber):
         return self.stateTable.iloc[stateNumber]
 
     def calculateRewardPerAction(self, startingState, actionList, debug=True):
+        currentState = self.findStateInStateTable(startingState)
+        if currentState is None:
+            print("state not found based on features", startingState)
+            exit()
         if debug:
-            currentState = self.findStateInStateTable(startingState)
             print("Current state",currentState)
-        actionToTake = actionList[0]
-        actionList = actionList[1:]
-        reward = np.array([])
-        reward = np.append(reward, self.calculateStateActionValue(startingState, actionToTake))
 
-        for action in actionList:
-            reward = np.append(reward, self.calculateStateActionValue(startingState, action))
+        reward = self.qTable[currentState, np.asarray(actionList, dtype=np.int64)]
+
+        if debug:
+            for action, actionReward in zip(actionList, reward):
+                print("Action", action, "results in an estimated reward of", actionReward)
 
         return reward
+
+    def calculateStateActionValues(self, features, actions):
+        """
+        Returns the expected reward of a batch of (state features, action) pairs, e.g. all steps of a recorded
+        trajectory store. features is an array of shape (n, 2) and actions an array of n actions.
+        Pairs of unknown states are given NaN.
+        """
+        states = self.findStatesInStateTable(np.asarray(features, dtype=np.float64).reshape(-1, 2))
+        actions = np.asarray(actions, dtype=np.int64).reshape(-1)
+
+        known = states >= 0
+        values = np.full(len(states), np.nan)
+        values[known] = self.qTable[states[known], actions[known]]
+        return values
  
 
 def main():
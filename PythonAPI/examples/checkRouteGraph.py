@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+# Check used for the experiment described in the bachelor thesis by Enrico Bonsu.
+#
+# This work is licensed under the terms of the MIT license.
+# For a copy, see <https://opensource.org/licenses/MIT>.
+
+"""
+Checks that an exported road graph of the GlobalRoutePlanner gives the same routes as the built graph.
+
+The graph of the current map is built, exported and imported again. The routes between random pairs of spawn
+points are traced with both planners and compared waypoint by waypoint. The waypoints of the imported graph are
+stored waypoints, of which all attributes that are not stored in the graph file (such as lane_type and next) are
+taken from the map, these are compared as well.
+"""
+
+from __future__ import print_function
+
+import argparse
+import glob
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+# ==============================================================================
+# -- Find CARLA module ---------------------------------------------------------
+# ==============================================================================
+try:
+    sys.path.append(glob.glob('../carla/dist/carla-*%d.%d-%s.egg' % (
+        sys.version_info.major,
+        sys.version_info.minor,
+        'win-amd64' if os.name == 'nt' else 'linux-x86_64'))[0])
+except IndexError:
+    pass
+
+# ==============================================================================
+# -- Add PythonAPI for release mode --------------------------------------------
+# ==============================================================================
+try:
+    sys.path.append(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))) + '/carla')
+except IndexError:
+    pass
+
+import carla
+
+from agents.navigation.global_route_planner import GlobalRoutePlanner, _StoredWaypoint  # pylint: disable=import-error
+
+
+def describe(waypoint, road_option, sampling_resolution):
+    """
+    Returns the attributes of a traced waypoint that must be equal for the built and imported graph
+    """
+    location = waypoint.transform.location
+    next_waypoints = waypoint.next(sampling_resolution)
+    return (round(location.x, 3), round(location.y, 3), round(location.z, 3),
+            round(waypoint.transform.rotation.yaw, 3), waypoint.road_id, waypoint.section_id, waypoint.lane_id,
+            waypoint.is_junction, int(road_option), waypoint.lane_type, len(next_waypoints))
+
+
+def check_round_trip(wmap, sampling_resolution=2.0, routes=50, seed=0):
+    """
+    Builds, exports and imports the graph of the map and compares the traced routes between random pairs of
+    spawn points. Returns the number of routes that differ.
+    """
+    graph_dir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        built = GlobalRoutePlanner(wmap, sampling_resolution, graph_dir=graph_dir)
+        print("Graph built and exported in", round(time.time() - start, 3), "seconds")
+
+        start = time.time()
+        imported = GlobalRoutePlanner(wmap, sampling_resolution, graph_dir=graph_dir)
+        print("Graph imported in", round(time.time() - start, 3), "seconds")
+    finally:
+        shutil.rmtree(graph_dir, ignore_errors=True)
+
+    if list(built._graph.edges) != list(imported._graph.edges):
+        print("The imported graph has different edges")
+        return routes
+
+    spawn_points = wmap.get_spawn_points()
+    random.seed(seed)
+    differences = 0
+    stored = 0
+    for _ in range(routes):
+        origin, destination = random.sample(spawn_points, 2)
+        built_route = built.trace_route(origin.location, destination.location)
+        imported_route = imported.trace_route(origin.location, destination.location)
+        stored += sum(isinstance(waypoint, _StoredWaypoint) for waypoint, _ in imported_route)
+
+        if [describe(w, o, sampling_resolution) for w, o in built_route] \
+                != [describe(w, o, sampling_resolution) for w, o in imported_route]:
+            differences += 1
+            print("Route from", origin.location, "to", destination.location, "differs")
+
+    print(routes - differences, "of", routes, "routes are equal,", stored, "stored waypoints compared")
+    return differences
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Compare the routes of an exported and imported road graph')
+    argparser.add_argument(
+        '--host',
+        default='127.0.0.1',
+        help='IP of the host server (default: 127.0.0.1)')
+    argparser.add_argument(
+        '-p', '--port',
+        default=2000,
+        type=int,
+        help='TCP port to listen to (default: 2000)')
+    argparser.add_argument(
+        '--resolution',
+        default=2.0,
+        type=float,
+        help='Sampling resolution of the route planner (default: 2.0)')
+    argparser.add_argument(
+        '-n', '--routes',
+        default=50,
+        type=int,
+        help='Number of compared routes (default: 50)')
+    argparser.add_argument(
+        '-s', '--seed',
+        default=0,
+        type=int,
+        help='Seed of the random spawn point pairs (default: 0)')
+    args = argparser.parse_args()
+
+    client = carla.Client(args.host, args.port)
+    client.set_timeout(60.0)
+    differences = check_round_trip(client.get_world().get_map(), args.resolution, args.routes, args.seed)
+    sys.exit(1 if differences else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -103,11 +103,13 @@ def args():
     return args
 
 
-def main(scenario=0, case=0, drawObservationValues=False, drawStart=False, drawDestination=False, featureweights=None):
+def main(scenario=0, case=0, drawObservationValues=False, drawStart=False, drawDestination=False, featureweights=None,
+         modelFile=None, mmap=None, reloadTicks=25):
     world = None
     irlRewardClass = None
-    if featureweights:
-        irlRewardClass = IRLReward(featureweights)
+    carlaFeatureHelper = None
+    if featureweights or modelFile:
+        irlRewardClass = IRLReward(featureweights, modelFile, mmap)
 
     try:
         # Initializing CARLA client and server
@@ -202,6 +204,7 @@ def main(scenario=0, case=0, drawObservationValues=False, drawStart=False, drawD
                 isDone = False
                 possibleActions = [0, 1]
                 actionToTake = possibleActions[0]
+                ticks = 0
 
                 # Init generateFeatures function
                 carlaFeatureHelper.generateFeatures(
@@ -228,11 +231,19 @@ def main(scenario=0, case=0, drawObservationValues=False, drawStart=False, drawD
                     # exit when agent is within 5 % of the goal.
                     if (currentObservation[1] < 0.05):
                         exit()
+                    # Use a new reward model written by carlaMaxIRL, checked every reloadTicks ticks (3 seconds of
+                    # simulated time by default)
+                    ticks += 1
+                    if ticks % reloadTicks == 0 and irlRewardClass.reloadRewardModel():
+                        print("Reward model version", irlRewardClass.modelVersion, "loaded")
                     rewardPerAction = irlRewardClass.calculateRewardPerAction(startingState=currentObservation,
                                                                               actionList=possibleActions)
                     drawObservation(client, agent, currentObservation,
                                     rewardPerAction, possibleActions, case)
-                    actionToTake = possibleActions[np.argmax(rewardPerAction)]
+                    actionToTake = irlRewardClass.bestAction(currentObservation, possibleActions)
+                    if actionToTake is None:
+                        # No action is known in this state, the agent follows its default controller
+                        actionToTake = possibleActions[0]
                     # print("actionToTake", actionToTake)
 
             elif case == 3:
@@ -243,7 +254,9 @@ def main(scenario=0, case=0, drawObservationValues=False, drawStart=False, drawD
                 trafficLightCode, trajectoryDone, brake = trafficLoop.tick_action(world,
                                                                                   agent, destination, traffic_manager, scenario=scenario, client=client)
                 if trajectoryDone:
-                    carlaFeatureHelper.saveTrajectory()
+                    if carlaFeatureHelper.saveTrajectory():
+                        # The maximum number of trajectories has been observed
+                        exit()
                 else:
                     features = carlaFeatureHelper.generateFeatures(
                         trafficLightMsg=trafficLightCode, agent=agent, destination=destination)
@@ -256,6 +269,8 @@ def main(scenario=0, case=0, drawObservationValues=False, drawStart=False, drawD
             else:
                 exit()
     finally:
+        if carlaFeatureHelper is not None:
+            carlaFeatureHelper.closeTrajectories()
         if world is not None:
             settings = world.world.get_settings()
             settings.synchronous_mode = False